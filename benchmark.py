@@ -0,0 +1,378 @@
+"""Offline benchmark for the paper generation pipeline.
+
+Starts a local stand-in for the OpenRouter chat completions endpoint and drives either
+generate_research_paper() directly or the /generate job API against it, then reports
+latency percentiles, throughput and retry counts. No API credits or network needed.
+
+    python benchmark.py --target pipeline --requests 20 --concurrency 4
+    python benchmark.py --target http --latency-dist lognormal --latency-ms 800 --rate-429 0.05
+"""
+import re
+import json
+import time
+import random
+import logging
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import requests
+
+import main
+
+
+class MockOpenRouter:
+    """Local chat completions server with configurable latency, token rate and error injection.
+
+    Responses are shaped after the prompts in main.py (outline JSON, skeletons with
+    section placeholders, sections, bibliographies, figures, polished fragments) so the
+    whole pipeline runs end to end. Thread-safe counters record what was served.
+    """
+    def __init__(self, latency_dist="lognormal", latency_ms=500.0, latency_sigma=0.5, tokens_per_second=200.0,
+                 rate_429=0.0, rate_5xx=0.0, retry_after=1, section_words=300, seed=None):
+        self.latency_dist = latency_dist
+        self.latency_ms = latency_ms
+        self.latency_sigma = latency_sigma
+        self.tokens_per_second = tokens_per_second
+        self.rate_429 = rate_429
+        self.rate_5xx = rate_5xx
+        self.retry_after = retry_after
+        self.section_words = section_words
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counts = {'requests': 0, 'streamed': 0, '429': 0, '5xx': 0, 'aborted': 0}
+        self.server = None
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def first_token_delay(self):
+        """Seconds before the first token (or error) of a response, drawn from the latency distribution"""
+        median = self.latency_ms / 1000.0
+        with self.lock:
+            if self.latency_dist == "fixed":
+                return median
+            if self.latency_dist == "uniform":
+                return self.random.uniform(0, 2 * median)
+            if self.latency_dist == "exponential":
+                return self.random.expovariate(1 / median) if median > 0 else 0
+            return self.random.lognormvariate(0, self.latency_sigma) * median
+
+    def injected_error(self):
+        with self.lock:
+            roll = self.random.random()
+        if roll < self.rate_429:
+            return 429
+        if roll < self.rate_429 + self.rate_5xx:
+            return 503
+        return None
+
+    def words(self, count):
+        vocabulary = ["model", "data", "results", "analysis", "method", "evaluation", "system", "approach",
+                      "performance", "framework", "experiment", "baseline", "significant", "proposed"]
+        return " ".join(vocabulary[i % len(vocabulary)] for i in range(count)) + "."
+
+    def section(self, title):
+        return (f"\\section{{{title}}}\n{self.words(self.section_words)} \\cite{{ref1}}\n"
+                f"\\begin{{figure}}[h]\\centering\\begin{{tikzpicture}}\\draw (0,0) -- (1,1);\\end{{tikzpicture}}"
+                f"\\caption{{{title} overview}}\\end{{figure}}\n")
+
+    def paper(self, body):
+        return ("\\documentclass{article}\n\\usepackage{amsmath}\n\\usepackage{tikz}\n\\title{Benchmark Paper}\n"
+                "\\begin{document}\n\\maketitle\n\\begin{abstract}" + self.words(60) + "\\end{abstract}\n" + body +
+                "\n\\begin{thebibliography}{9}\n\\bibitem{ref1} A. Author. A reference. 2024.\n"
+                "\\end{thebibliography}\n\\end{document}")
+
+    def completion(self, messages):
+        system = messages[0]["content"] if messages else ""
+        prompt = messages[-1]["content"] if messages else ""
+        if "research assistant" in system:
+            sections = [{"title": f"Section {i + 1}", "points": ["background", "details"]} for i in range(6)]
+            return "```json\n" + json.dumps({"title": "Benchmark Paper", "sections": sections}) + "\n```"
+        if "LaTeX expert" in system:
+            return json.dumps({"document_class": "article", "packages": ["amsmath", "tikz"]})
+        if "placeholder lines" in prompt:
+            return self.paper("\n".join(re.findall(r'%%SECTION \d+%%', prompt)))
+        if "writing one section" in prompt:
+            title = re.search(r'Start with \\section\{(.*?)\}', prompt)
+            return self.section(title.group(1) if title else "Section")
+        if "citation expert" in system:
+            keys = re.search(r'cited keys, keeping the keys unchanged: (.*?)\.\n', prompt)
+            keys = [key.strip() for key in keys.group(1).split(",")] if keys else ["ref1"]
+            items = "\n".join(f"\\bibitem{{{key}}} A. Author. {key}. 2024." for key in keys)
+            return f"\\begin{{thebibliography}}{{9}}\n{items}\n\\end{{thebibliography}}"
+        if "visualization expert" in system:
+            environment = re.search(r'\\begin\{([^}]*)\}[\s\S]*\\end\{\1\}', prompt)
+            return environment.group(0) if environment else ""
+        if "LaTeX editor" in system:
+            fragment = prompt.split("\n", 1)[-1].rsplit("\nReturn ONLY", 1)[0]
+            return fragment
+        return self.paper("\n".join(self.section(f"Section {i + 1}") for i in range(6)))
+
+    def handler(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def send_json(self, status, body, headers=()):
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in headers:
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                mock.count('requests')
+                delay = mock.first_token_delay()
+                error = mock.injected_error()
+                if payload.get("stream") and not error:
+                    # OpenRouter sends stream headers at once and keeps the connection alive until the first token
+                    return self.stream(mock.completion(payload.get("messages", [])), payload, delay)
+                time.sleep(delay)
+                if error == 429:
+                    mock.count('429')
+                    return self.send_json(429, {"error": {"code": 429, "message": "Rate limited"}},
+                                          [("Retry-After", str(mock.retry_after))])
+                if error:
+                    mock.count('5xx')
+                    return self.send_json(error, {"error": {"code": error, "message": "Upstream unavailable"}})
+                text = mock.completion(payload.get("messages", []))
+                usage = self.usage(payload, text)
+                if mock.tokens_per_second > 0:
+                    time.sleep(usage["completion_tokens"] / mock.tokens_per_second)
+                self.send_json(200, {"choices": [{"message": {"role": "assistant", "content": text},
+                                                  "finish_reason": "stop"}], "usage": usage})
+
+            @staticmethod
+            def usage(payload, text):
+                prompt_tokens = sum(len(m.get("content", "")) for m in payload.get("messages", [])) // 4
+                completion_tokens = max(1, len(text) // 4)
+                return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                        "total_tokens": prompt_tokens + completion_tokens}
+
+            def stream(self, text, payload, delay):
+                mock.count('streamed')
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                self.close_connection = True
+                try:
+                    self.wfile.write(b": OPENROUTER PROCESSING\n\n")
+                    self.wfile.flush()
+                    time.sleep(delay)
+                    chunk_chars = 16
+                    for start in range(0, len(text), chunk_chars):
+                        if mock.tokens_per_second > 0:
+                            time.sleep(chunk_chars / 4 / mock.tokens_per_second)
+                        chunk = {"choices": [{"delta": {"content": text[start:start + chunk_chars]}}]}
+                        self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+                        self.wfile.flush()
+                    usage = self.usage(payload, text)
+                    self.wfile.write(f"data: {json.dumps({'choices': [], 'usage': usage})}\n\n".encode("utf-8"))
+                    self.wfile.write(b"data: [DONE]\n\n")
+                    self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    # The client cancelled the call, e.g. a losing hedge
+                    mock.count('aborted')
+
+        return Handler
+
+    def start(self, host="127.0.0.1", port=0):
+        """Serve in a background thread; returns the chat completions URL"""
+        self.server = ThreadingHTTPServer((host, port), self.handler())
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name="mock-openrouter", daemon=True).start()
+        return f"http://{host}:{self.server.server_port}/api/v1/chat/completions"
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a list of numbers"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(fraction * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def run_pipeline_request(topic):
+    main.generate_research_paper(topic)
+
+
+def start_app_server():
+    """Serve the Flask app on a free local port in a background thread; returns its base URL"""
+    from werkzeug.serving import make_server
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    server = make_server("127.0.0.1", 0, main.app, threaded=True)
+    threading.Thread(target=server.serve_forever, name="benchmark-app", daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}", server
+
+
+def make_http_request(base_url, session, poll_interval):
+    def request(topic):
+        response = session.post(f"{base_url}/generate", json={"topic": topic}, timeout=30)
+        job = response.json()
+        if "error" in job and "job_id" not in job:
+            raise Exception(job["error"])
+        while job["status"] in ("queued", "running"):
+            time.sleep(poll_interval)
+            job = session.get(f"{base_url}{job['status_url']}", timeout=30).json()
+        if job["status"] != "completed":
+            raise Exception(job.get("error", job["status"]))
+    return request
+
+
+def metric_total(name):
+    with main.metrics.lock:
+        return sum(value for (metric, _), value in main.metrics.values.items() if metric == name)
+
+
+def stage_means():
+    with main.metrics.lock:
+        histograms = {key: dict(h) for key, h in main.metrics.histograms.items()}
+    means = {}
+    for (name, labels), histogram in histograms.items():
+        labels = dict(labels)
+        if name == "paper_stage_duration_seconds" and labels.get("outcome") == "ok" and histogram['count']:
+            means[labels['stage']] = histogram['sum'] / histogram['count']
+    return means
+
+
+def run_benchmark(args):
+    mock = MockOpenRouter(latency_dist=args.latency_dist, latency_ms=args.latency_ms, latency_sigma=args.latency_sigma,
+                          tokens_per_second=args.tokens_per_second, rate_429=args.rate_429, rate_5xx=args.rate_5xx,
+                          retry_after=args.retry_after, section_words=args.section_words, seed=args.seed)
+    url = mock.start()
+    # Measure generation, not the cache: no paper, checkpoint or semantic reuse between requests
+    main.ENABLE_CACHING = False
+    main.GENERATION_MODE = args.mode
+    main.RETRY_DELAY = args.retry_delay
+    main.openrouter_client = main.OpenRouterClient(url=url, max_concurrency=args.api_concurrency,
+                                                   rate_limit=args.rate_limit, pool_size=max(args.api_concurrency, 1))
+    # The mock serves every model name; fallbacks only matter as hedge targets here
+    main.FALLBACK_MODELS = [m.strip() for m in args.fallback_models.split(",") if m.strip()]
+    main.model_router = main.ModelRouter(hedging=args.fallback_models != "")
+    server = None
+    if args.target == "http":
+        main.JOB_WORKERS = args.concurrency
+        base_url, server = start_app_server()
+        request = make_http_request(base_url, requests.Session(), args.poll_interval)
+    else:
+        request = run_pipeline_request
+
+    latencies = []
+    failures = []
+    lock = threading.Lock()
+
+    def timed(index):
+        topic = f"Benchmark topic {index} {random.random()}"
+        started = time.perf_counter()
+        try:
+            request(topic)
+        except Exception as e:
+            with lock:
+                failures.append(str(e))
+            return
+        with lock:
+            latencies.append(time.perf_counter() - started)
+
+    retries_before = metric_total("openrouter_retries_total")
+    hedges_before = metric_total("openrouter_hedges_total")
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(timed, range(args.requests)))
+    elapsed = time.perf_counter() - started
+    if server:
+        server.shutdown()
+    mock.stop()
+
+    return {
+        'target': args.target,
+        'mode': args.mode,
+        'requests': args.requests,
+        'concurrency': args.concurrency,
+        'completed': len(latencies),
+        'failed': len(failures),
+        'elapsed_seconds': elapsed,
+        'throughput_per_minute': len(latencies) / elapsed * 60 if elapsed else 0.0,
+        'latency_p50': percentile(latencies, 0.50),
+        'latency_p95': percentile(latencies, 0.95),
+        'latency_p99': percentile(latencies, 0.99),
+        'retries': metric_total("openrouter_retries_total") - retries_before,
+        'hedges': metric_total("openrouter_hedges_total") - hedges_before,
+        'api_requests': mock.counts['requests'],
+        'injected_429': mock.counts['429'],
+        'injected_5xx': mock.counts['5xx'],
+        'aborted': mock.counts['aborted'],
+        'stage_mean_seconds': stage_means(),
+        'errors': sorted(set(failures))[:5],
+    }
+
+
+def print_report(report):
+    print(f"target={report['target']} mode={report['mode']} requests={report['requests']} "
+          f"concurrency={report['concurrency']}")
+    print(f"completed={report['completed']} failed={report['failed']} elapsed={report['elapsed_seconds']:.2f}s "
+          f"throughput={report['throughput_per_minute']:.2f} papers/min")
+    print(f"latency p50={report['latency_p50']:.2f}s p95={report['latency_p95']:.2f}s p99={report['latency_p99']:.2f}s")
+    print(f"api requests={report['api_requests']} retries={report['retries']} hedges={report['hedges']} "
+          f"aborted={report['aborted']} injected 429={report['injected_429']} 5xx={report['injected_5xx']}")
+    for stage, seconds in sorted(report['stage_mean_seconds'].items(), key=lambda item: -item[1]):
+        print(f"  stage {stage:<10} mean {seconds:.2f}s")
+    for error in report['errors']:
+        print(f"  error: {error}")
+
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline against a local mock OpenRouter server")
+    parser.add_argument("--target", choices=["pipeline", "http"], default="pipeline",
+                        help="call generate_research_paper() directly, or go through POST /generate and /jobs")
+    parser.add_argument("--mode", choices=["sections", "single"], default=main.GENERATION_MODE,
+                        help="content generation mode")
+    parser.add_argument("--requests", type=int, default=20, help="papers to generate")
+    parser.add_argument("--concurrency", type=int, default=4, help="papers in flight at once")
+    parser.add_argument("--latency-dist", choices=["fixed", "uniform", "exponential", "lognormal"], default="lognormal",
+                        help="distribution of mock time-to-first-token")
+    parser.add_argument("--latency-ms", type=float, default=500.0, help="median (or mean) time-to-first-token")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="lognormal shape; larger means a longer tail")
+    parser.add_argument("--tokens-per-second", type=float, default=200.0, help="mock generation speed, 0 for instant")
+    parser.add_argument("--section-words", type=int, default=300, help="words in each mock section")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="fraction of mock responses that are 429")
+    parser.add_argument("--rate-5xx", type=float, default=0.0, help="fraction of mock responses that are 503")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After seconds sent with 429s")
+    parser.add_argument("--retry-delay", type=float, default=0.2, help="client backoff base (RETRY_DELAY)")
+    parser.add_argument("--api-concurrency", type=int, default=main.OPENROUTER_MAX_CONCURRENCY,
+                        help="client limit on in-flight API requests")
+    parser.add_argument("--rate-limit", type=float, default=0, help="client requests per second, 0 disables")
+    parser.add_argument("--poll-interval", type=float, default=0.1, help="job polling interval for --target http")
+    parser.add_argument("--fallback-models", default="",
+                        help="comma-separated fallback models; enables hedging of slow calls")
+    parser.add_argument("--seed", type=int, help="seed for latency and error sampling")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args(argv)
+
+    report = run_benchmark(args)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+    return 0 if report['failed'] == 0 else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main_cli())
@@ -1,12 +1,37 @@
 import os
+import re
+import sys
+import logging
+import argparse
 import json
 import time
-from datetime import datetime
+import zlib
+import sqlite3
+import hashlib
+import tempfile
+import unicodedata
+import uuid
+import queue
+import random
+import socket
+import threading
+from collections import OrderedDict, deque
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, Response, render_template, request, jsonify, send_file, url_for
 import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import numpy as np
+except ImportError:  # the semantic topic index is disabled without NumPy
+    np = None
 
 app = Flask(__name__)
+logger = logging.getLogger(__name__)
 
 # Configuration
 OPENROUTER_API_KEY = "abcd"
@@ -16,102 +41,1449 @@ CACHE_DIR = "paper_cache"
 MAX_RETRIES = 3
 RETRY_DELAY = 2
 
-# Ensure cache directory exists
-if ENABLE_CACHING:
-    os.makedirs(CACHE_DIR, exist_ok=True)
+# OpenRouter client configuration. RETRY_DELAY is the base of the exponential backoff.
+OPENROUTER_API_URL = os.environ.get("OPENROUTER_API_URL", "https://openrouter.ai/api/v1/chat/completions")
+OPENROUTER_CONNECT_TIMEOUT = float(os.environ.get("OPENROUTER_CONNECT_TIMEOUT", "10"))
+OPENROUTER_READ_TIMEOUT = float(os.environ.get("OPENROUTER_READ_TIMEOUT", "300"))
+OPENROUTER_POOL_SIZE = int(os.environ.get("OPENROUTER_POOL_SIZE", "32"))
+OPENROUTER_MAX_CONCURRENCY = int(os.environ.get("OPENROUTER_MAX_CONCURRENCY", "8"))
+OPENROUTER_RATE_LIMIT = float(os.environ.get("OPENROUTER_RATE_LIMIT", "2"))  # requests per second, 0 disables
+OPENROUTER_RATE_BURST = int(os.environ.get("OPENROUTER_RATE_BURST", "5"))
+RETRY_MAX_DELAY = 60
 
-def get_cached_paper(topic):
-    """Retrieve paper from cache if available"""
-    if not ENABLE_CACHING:
-        return None
-    topic_hash = str(hash(topic))
-    cache_file = os.path.join(CACHE_DIR, f"{topic_hash}.json")
-    if os.path.exists(cache_file):
+# Model routing. Each call stage (outline, template, content, skeleton, section, citations,
+# diagrams, polish) tries an ordered list of models: STAGE_MODELS is a JSON object mapping
+# stage to list, and unlisted stages use LLM_MODEL_NAME followed by FALLBACK_MODELS
+# (comma-separated). A call still waiting past the observed HEDGE_QUANTILE latency of its
+# stage and model gets a duplicate on the next model; the first response wins and the other
+# is cancelled. A model that fails CIRCUIT_FAILURES calls in a row is skipped for
+# CIRCUIT_COOLDOWN seconds.
+FALLBACK_MODELS = [m.strip() for m in os.environ.get("FALLBACK_MODELS", "").split(",") if m.strip()]
+STAGE_MODELS = json.loads(os.environ.get("STAGE_MODELS", "{}"))
+ENABLE_HEDGING = os.environ.get("ENABLE_HEDGING", "1") == "1"
+HEDGE_QUANTILE = float(os.environ.get("HEDGE_QUANTILE", "0.95"))
+HEDGE_MIN_SAMPLES = int(os.environ.get("HEDGE_MIN_SAMPLES", "20"))
+HEDGE_WINDOW = int(os.environ.get("HEDGE_WINDOW", "200"))
+CIRCUIT_FAILURES = int(os.environ.get("CIRCUIT_FAILURES", "3"))
+CIRCUIT_COOLDOWN = float(os.environ.get("CIRCUIT_COOLDOWN", "120"))
+
+# Cache tiers: an in-process LRU in front of a compressed SQLite paper store
+PAPER_DB = os.path.join(CACHE_DIR, "papers.db")
+CACHE_MEMORY_ITEMS = int(os.environ.get("CACHE_MEMORY_ITEMS", "128"))
+CACHE_TTL = int(os.environ.get("CACHE_TTL", str(30 * 24 * 3600)))  # seconds, 0 keeps entries forever
+CACHE_MAX_BYTES = int(os.environ.get("CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+# Per-stage checkpoints, so a failed run resumes from its last completed stage
+CHECKPOINT_DIR = os.path.join(CACHE_DIR, "stages")
+CHECKPOINT_MAX_BYTES = int(os.environ.get("CHECKPOINT_MAX_BYTES", str(256 * 1024 * 1024)))
+# Near-duplicate topic reuse: a TF-IDF index over cached topics. A cached paper is
+# returned at or above the paper threshold; a cached outline is reused at or above the
+# (lower) outline threshold. Requires NumPy.
+ENABLE_SEMANTIC_CACHE = os.environ.get("ENABLE_SEMANTIC_CACHE", "1") == "1"
+SEMANTIC_PAPER_THRESHOLD = float(os.environ.get("SEMANTIC_PAPER_THRESHOLD", "0.92"))
+SEMANTIC_OUTLINE_THRESHOLD = float(os.environ.get("SEMANTIC_OUTLINE_THRESHOLD", "0.75"))
+# Bump when prompts or stages change so papers from the old pipeline stop matching
+PIPELINE_VERSION = 1
+
+# Job queue configuration
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "4"))
+JOB_QUEUE_SIZE = int(os.environ.get("JOB_QUEUE_SIZE", "100"))
+JOB_RETENTION = int(os.environ.get("JOB_RETENTION", "3600"))
+
+# "sections" writes each outline section in its own concurrent call and assembles them
+# into a separately generated skeleton; "single" asks for the whole paper in one call
+GENERATION_MODE = os.environ.get("GENERATION_MODE", "sections")
+SECTION_WORKERS = int(os.environ.get("SECTION_WORKERS", "6"))
+SECTION_MAX_TOKENS = int(os.environ.get("SECTION_MAX_TOKENS", "4000"))
+# Concurrent calls used by the citation, diagram and polish stages, which rewrite
+# individual fragments of the paper rather than the whole document
+FRAGMENT_WORKERS = int(os.environ.get("FRAGMENT_WORKERS", "6"))
+
+# How long a request waits on an identical in-flight generation before giving up
+SINGLE_FLIGHT_TIMEOUT = float(os.environ.get("SINGLE_FLIGHT_TIMEOUT", "900"))
+
+# Bulk generation from JSONL topic lists
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", "4"))
+BATCH_DIR = os.environ.get("BATCH_DIR", "batch_output")
+
+# Production server (python main.py serve)
+SERVE_HOST = os.environ.get("SERVE_HOST", "0.0.0.0")
+SERVE_PORT = int(os.environ.get("SERVE_PORT", "8000"))
+SERVE_CONNECTIONS = int(os.environ.get("SERVE_CONNECTIONS", "1000"))
+SERVE_JOB_WORKERS = int(os.environ.get("SERVE_JOB_WORKERS", "200"))
+
+# Logging verbosity; DEBUG also logs every OpenRouter request payload
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+
+def configure_logging():
+    logging.basicConfig(level=LOG_LEVEL.upper(), format="%(asctime)s %(levelname)s %(name)s %(message)s")
+
+# gunicorn imports main:app and never calls main(), so its worker configures logging here
+if "gunicorn" in sys.modules:
+    configure_logging()
+
+# Pipeline stages in execution order, reported to clients as job progress
+STAGES = ["outline", "template", "content", "citations", "diagrams", "polish"]
+
+class Metrics:
+    """Thread-safe registry of counters, gauges and histograms, rendered in the Prometheus
+    text exposition format by /metrics. Series are identified by name plus labels."""
+    DEFAULT_BUCKETS = (0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.kinds = {}
+        self.help = {}
+        self.buckets = {}
+        self.values = {}
+        self.histograms = {}
+
+    def describe(self, name, kind, help_text, buckets=None):
+        self.kinds[name] = kind
+        self.help[name] = help_text
+        if buckets:
+            self.buckets[name] = buckets
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.values[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        buckets = self.buckets.get(name, self.DEFAULT_BUCKETS)
+        with self.lock:
+            histogram = self.histograms.setdefault(key, {'buckets': [0] * len(buckets), 'sum': 0.0, 'count': 0})
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram['buckets'][i] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+        return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+    def render(self):
+        with self.lock:
+            values = sorted(self.values.items())
+            histograms = sorted((key, dict(h, buckets=list(h['buckets']))) for key, h in self.histograms.items())
+        lines = []
+        described = set()
+
+        def header(name):
+            if name not in described and name in self.kinds:
+                lines.append(f"# HELP {name} {self.help[name]}")
+                lines.append(f"# TYPE {name} {self.kinds[name]}")
+                described.add(name)
+
+        for (name, labels), value in values:
+            header(name)
+            lines.append(f"{name}{self._labels(labels)} {value}")
+        for (name, labels), histogram in histograms:
+            header(name)
+            buckets = self.buckets.get(name, self.DEFAULT_BUCKETS)
+            for bound, count in zip(buckets, histogram['buckets']):
+                lines.append(f"{name}_bucket{self._labels(labels, [('le', bound)])} {count}")
+            lines.append(f"{name}_bucket{self._labels(labels, [('le', '+Inf')])} {histogram['count']}")
+            lines.append(f"{name}_sum{self._labels(labels)} {histogram['sum']}")
+            lines.append(f"{name}_count{self._labels(labels)} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.describe("paper_stage_duration_seconds", "histogram", "Wall-clock time of pipeline stages that ran, by stage and outcome")
+metrics.describe("paper_stage_runs_total", "counter", "Pipeline stage executions by stage and outcome (ok, failed, checkpoint)")
+metrics.describe("paper_generation_duration_seconds", "histogram", "Wall-clock time of full pipeline runs")
+metrics.describe("openrouter_requests_total", "counter", "OpenRouter HTTP attempts by stage and result")
+metrics.describe("openrouter_request_duration_seconds", "histogram", "Latency of successful OpenRouter calls by stage and model")
+metrics.describe("openrouter_retries_total", "counter", "OpenRouter retries by stage")
+metrics.describe("openrouter_tokens_total", "counter", "Tokens reported in OpenRouter usage by stage and kind")
+metrics.describe("openrouter_hedges_total", "counter", "Duplicate requests sent to a fallback model, by stage and result (won, lost)")
+metrics.describe("openrouter_fallbacks_total", "counter", "Calls retried on the next model after a model failed, by stage")
+metrics.describe("model_circuit_open", "gauge", "1 while a model is skipped by its circuit breaker")
+metrics.describe("paper_cache_requests_total", "counter", "Paper cache lookups by tier and result")
+metrics.describe("semantic_cache_requests_total", "counter", "Near-duplicate topic lookups by use (paper, outline) and result")
+metrics.describe("paper_generations_coalesced_total", "counter", "Requests that joined an identical in-flight generation")
+metrics.describe("jobs", "gauge", "Jobs currently held by the server, by status")
+metrics.describe("job_queue_depth", "gauge", "Jobs waiting for a worker")
+
+class LRUCache:
+    """Thread-safe in-memory LRU mapping holding at most max_items entries.
+
+    With a ttl, entries older than ttl seconds (counted from the `created` time given
+    to put, by default the time of the put) are dropped on read.
+    """
+    def __init__(self, max_items, ttl=0):
+        self.max_items = max_items
+        self.ttl = ttl
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.items:
+                return None
+            created, value = self.items[key]
+            if self.ttl > 0 and time.time() - created > self.ttl:
+                del self.items[key]
+                return None
+            self.items.move_to_end(key)
+            return value
+
+    def put(self, key, value, created=None):
+        if self.max_items <= 0:
+            return
+        with self.lock:
+            self.items[key] = (created if created is not None else time.time(), value)
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_items:
+                self.items.popitem(last=False)
+
+    def discard(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+class DiskCache:
+    """One JSON file per key in a directory, with TTL expiry and a total-size limit.
+
+    Files are written to a temporary name and renamed into place, so readers never see
+    a partial entry. When the directory grows past max_bytes the least recently used
+    files (by mtime, which reads refresh) are evicted.
+    """
+    def __init__(self, directory, ttl=CACHE_TTL, max_bytes=CACHE_MAX_BYTES):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.evict_lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def expired(self, entry):
+        return self.ttl > 0 and time.time() - entry.get('created', 0) > self.ttl
+
+    def get(self, key):
+        cache_file = self.path(key)
         try:
             with open(cache_file, 'r', encoding='utf-8') as f:
-                cache_data = json.load(f)
-                return cache_data.get('paper')
+                entry = json.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning("Cache read error: %s", e)
+            return None
+        if self.expired(entry):
+            self.remove(key)
+            return None
+        try:
+            os.utime(cache_file)
+        except OSError:
+            pass
+        return entry
+
+    def put(self, key, entry):
+        entry = dict(entry, created=time.time())
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(entry, f, ensure_ascii=False)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path(key))
         except Exception as e:
-            print(f"Cache read error: {str(e)}")
+            logger.warning("Cache write error: %s", e)
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+        self.evict()
+
+    def remove(self, key):
+        try:
+            os.remove(self.path(key))
+        except OSError:
+            pass
+
+    def evict(self):
+        """Drop the oldest entries until the directory fits in max_bytes"""
+        with self.evict_lock:
+            files = []
+            for item in os.scandir(self.directory):
+                if item.is_file() and item.name.endswith('.json'):
+                    try:
+                        stat = item.stat()
+                    except FileNotFoundError:
+                        continue
+                    files.append((stat.st_mtime, stat.st_size, item.path))
+            total = sum(size for _, size, _ in files)
+            for _, size, path in sorted(files):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+
+class PaperStore:
+    """Generated papers in SQLite, zlib-compressed, indexed by topic, model, time and size.
+
+    Rows with a cache_key are the cache entries for a topic under given parameters.
+    Entries expire after ttl seconds and the least recently read are evicted once the
+    compressed total passes max_bytes; on_evict, if given, is called with the cache key of
+    every entry removed that way. Edited versions of a paper have no cache_key and a
+    parent_id; they are kept until deleted and do not count toward max_bytes. The outline a paper was written from is kept
+    with it, as JSON, for regenerating its sections. One connection is shared under a lock; every
+    statement is short.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS papers (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            cache_key TEXT UNIQUE,
+            topic TEXT NOT NULL,
+            topic_norm TEXT NOT NULL,
+            model TEXT NOT NULL,
+            params TEXT NOT NULL,
+            fingerprint TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            accessed_at REAL NOT NULL,
+            size INTEGER NOT NULL,
+            stored_size INTEGER NOT NULL,
+            paper BLOB NOT NULL,
+            parent_id INTEGER,
+            version INTEGER NOT NULL DEFAULT 1,
+            outline TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_papers_topic ON papers(topic_norm);
+        CREATE INDEX IF NOT EXISTS idx_papers_model ON papers(model);
+        CREATE INDEX IF NOT EXISTS idx_papers_created ON papers(created_at);
+        CREATE INDEX IF NOT EXISTS idx_papers_size ON papers(size);
+        CREATE INDEX IF NOT EXISTS idx_papers_accessed ON papers(accessed_at);
+    """
+    # Full-text index over topics for /papers search, kept in sync with the table by triggers
+    FTS_SCHEMA = """
+        CREATE VIRTUAL TABLE papers_fts USING fts5(topic_norm, content='papers', content_rowid='id');
+        CREATE TRIGGER papers_fts_insert AFTER INSERT ON papers BEGIN
+            INSERT INTO papers_fts(rowid, topic_norm) VALUES (new.id, new.topic_norm);
+        END;
+        CREATE TRIGGER papers_fts_delete AFTER DELETE ON papers BEGIN
+            INSERT INTO papers_fts(papers_fts, rowid, topic_norm) VALUES ('delete', old.id, old.topic_norm);
+        END;
+        CREATE TRIGGER papers_fts_update AFTER UPDATE OF topic_norm ON papers BEGIN
+            INSERT INTO papers_fts(papers_fts, rowid, topic_norm) VALUES ('delete', old.id, old.topic_norm);
+            INSERT INTO papers_fts(rowid, topic_norm) VALUES (new.id, new.topic_norm);
+        END;
+        INSERT INTO papers_fts(papers_fts) VALUES ('rebuild');
+    """
+    # Columns added since the first schema, with their definitions, for upgrading older databases
+    ADDED_COLUMNS = {'parent_id': "INTEGER", 'version': "INTEGER NOT NULL DEFAULT 1", 'outline': "TEXT"}
+    LIST_COLUMNS = "id, topic, model, created_at, size, stored_size, parent_id, version"
+
+    def __init__(self, path, ttl=CACHE_TTL, max_bytes=CACHE_MAX_BYTES, on_evict=None):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.on_evict = on_evict
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(self.SCHEMA)
+        columns = {row['name'] for row in self.db.execute("PRAGMA table_info(papers)")}
+        for column, definition in self.ADDED_COLUMNS.items():
+            if column not in columns:
+                self.db.execute(f"ALTER TABLE papers ADD COLUMN {column} {definition}")
+        self.db.execute("CREATE INDEX IF NOT EXISTS idx_papers_parent ON papers(parent_id)")
+        if not self.db.execute("SELECT 1 FROM sqlite_master WHERE name = 'papers_fts'").fetchone():
+            self.db.executescript(f"BEGIN; {self.FTS_SCHEMA} COMMIT;")
+
+    @staticmethod
+    def _entry(row):
+        entry = {key: row[key] for key in row.keys() if key != 'paper'}
+        entry['params'] = json.loads(row['params'])
+        entry['outline'] = json.loads(row['outline']) if row['outline'] else None
+        entry['paper'] = zlib.decompress(row['paper']).decode('utf-8')
+        entry['timestamp'] = datetime.fromtimestamp(row['created_at']).isoformat()
+        return entry
+
+    def get(self, key):
+        with self.lock:
+            row = self.db.execute("SELECT * FROM papers WHERE cache_key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if self.ttl > 0 and time.time() - row['created_at'] > self.ttl:
+                self.db.execute("DELETE FROM papers WHERE id = ?", (row['id'],))
+                self._evicted([key])
+                return None
+            self.db.execute("UPDATE papers SET accessed_at = ? WHERE id = ?", (time.time(), row['id']))
+        return self._entry(row)
+
+    def get_by_id(self, paper_id):
+        with self.lock:
+            row = self.db.execute("SELECT * FROM papers WHERE id = ?", (paper_id,)).fetchone()
+        return self._entry(row) if row is not None else None
+
+    def put(self, key, topic, paper, params, fingerprint, created_at=None, outline=None):
+        """Insert or replace the paper for a cache key; returns its row id"""
+        data = zlib.compress(paper.encode('utf-8'), 6)
+        now = time.time()
+        values = (key, topic, normalize_topic(topic), params.get('model', ''), json.dumps(params, sort_keys=True),
+                  fingerprint, created_at or now, now, len(paper.encode('utf-8')), len(data), data,
+                  json.dumps(outline) if outline else None)
+        with self.lock:
+            self.db.execute(
+                "INSERT INTO papers (cache_key, topic, topic_norm, model, params, fingerprint, created_at,"
+                " accessed_at, size, stored_size, paper, outline) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+                " ON CONFLICT(cache_key) DO UPDATE SET topic = excluded.topic, topic_norm = excluded.topic_norm,"
+                " model = excluded.model, params = excluded.params, fingerprint = excluded.fingerprint,"
+                " created_at = excluded.created_at, accessed_at = excluded.accessed_at, size = excluded.size,"
+                " stored_size = excluded.stored_size, paper = excluded.paper, outline = excluded.outline", values)
+            paper_id = self.db.execute("SELECT id FROM papers WHERE cache_key = ?", (key,)).fetchone()[0]
+            self._evict()
+        return paper_id
+
+    def add_version(self, parent, paper):
+        """Store an edited paper as a new version of the `parent` entry; returns its row id"""
+        data = zlib.compress(paper.encode('utf-8'), 6)
+        now = time.time()
+        values = (parent['topic'], parent['topic_norm'], parent['model'], json.dumps(parent['params'], sort_keys=True),
+                  parent['fingerprint'], now, now, len(paper.encode('utf-8')), len(data), data, parent['id'],
+                  parent['version'] + 1, json.dumps(parent['outline']) if parent['outline'] else None)
+        with self.lock:
+            cursor = self.db.execute(
+                "INSERT INTO papers (topic, topic_norm, model, params, fingerprint, created_at, accessed_at, size,"
+                " stored_size, paper, parent_id, version, outline) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                values)
+        return cursor.lastrowid
+
+    def _evicted(self, keys):
+        if self.on_evict:
+            for key in keys:
+                self.on_evict(key)
+
+    def _evict(self):
+        """Delete expired entries, then the least recently read until under max_bytes. Caller holds lock."""
+        if self.ttl > 0:
+            cutoff = time.time() - self.ttl
+            expired = self.db.execute("SELECT cache_key FROM papers WHERE cache_key IS NOT NULL AND created_at < ?",
+                                      (cutoff,)).fetchall()
+            self.db.execute("DELETE FROM papers WHERE cache_key IS NOT NULL AND created_at < ?", (cutoff,))
+            self._evicted(row[0] for row in expired)
+        total = self.db.execute("SELECT COALESCE(SUM(stored_size), 0) FROM papers"
+                                " WHERE cache_key IS NOT NULL").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        victims = []
+        for row in self.db.execute("SELECT id, cache_key, stored_size FROM papers WHERE cache_key IS NOT NULL"
+                                   " ORDER BY accessed_at"):
+            if total <= self.max_bytes:
+                break
+            victims.append(row)
+            total -= row['stored_size']
+        self.db.executemany("DELETE FROM papers WHERE id = ?", [(row['id'],) for row in victims])
+        self._evicted(row['cache_key'] for row in victims)
+
+    def delete(self, paper_id):
+        """Delete one paper or version; returns False if there is none with this id"""
+        with self.lock:
+            row = self.db.execute("SELECT cache_key FROM papers WHERE id = ?", (paper_id,)).fetchone()
+            if row is None:
+                return False
+            self.db.execute("DELETE FROM papers WHERE id = ?", (paper_id,))
+            if row['cache_key'] is not None:
+                self._evicted([row['cache_key']])
+        return True
+
+    def topics(self):
+        """(cache_key, topic, fingerprint) for every cache entry, for building the topic index"""
+        with self.lock:
+            return self.db.execute(
+                "SELECT cache_key, topic, fingerprint FROM papers WHERE cache_key IS NOT NULL").fetchall()
+
+    def search(self, query=None, model=None, page=1, per_page=20, sort='created'):
+        """One page of paper metadata, newest (or largest) first, plus the total match count.
+
+        query matches topics containing every word in it, each as a word prefix.
+        """
+        where, args = [], []
+        words = re.findall(r"\w+", normalize_topic(query or ""))
+        if words:
+            where.append("id IN (SELECT rowid FROM papers_fts WHERE papers_fts MATCH ?)")
+            args.append(" ".join(f'"{word}"*' for word in words))
+        if model:
+            where.append("model = ?")
+            args.append(model)
+        clause = f" WHERE {' AND '.join(where)}" if where else ""
+        order = "size DESC" if sort == 'size' else "created_at DESC"
+        with self.lock:
+            total = self.db.execute(f"SELECT COUNT(*) FROM papers{clause}", args).fetchone()[0]
+            rows = self.db.execute(f"SELECT {self.LIST_COLUMNS} FROM papers{clause} ORDER BY {order}, id DESC"
+                                   f" LIMIT ? OFFSET ?", args + [per_page, (page - 1) * per_page]).fetchall()
+        return [dict(row) for row in rows], total
+
+def normalize_topic(topic):
+    """Canonical form of a topic for cache keys: Unicode-normalized, case-folded, single-spaced"""
+    return " ".join(unicodedata.normalize("NFKC", topic).casefold().split())
+
+def generation_params():
+    """Settings that change the generated paper, and therefore belong in its cache key"""
+    return {'model': LLM_MODEL_NAME, 'pipeline_version': PIPELINE_VERSION, 'mode': GENERATION_MODE}
+
+def cache_key(topic, params=None):
+    """Stable content-addressed key for a topic under the given generation parameters"""
+    if params is None:
+        params = generation_params()
+    raw = json.dumps({'topic': normalize_topic(topic), 'params': params}, sort_keys=True)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+def forget_cache_entry(key):
+    """Drop a paper that expired or was evicted from the store from the memory tier and the topic index"""
+    memory_cache.discard(key)
+    if topic_index is not None:
+        topic_index.remove(key)
+
+memory_cache = LRUCache(CACHE_MEMORY_ITEMS, ttl=CACHE_TTL)
+paper_store = PaperStore(PAPER_DB, on_evict=forget_cache_entry) if ENABLE_CACHING else None
+stage_cache = DiskCache(CHECKPOINT_DIR, max_bytes=CHECKPOINT_MAX_BYTES) if ENABLE_CACHING else None
+
+STOPWORDS = frozenset("""a an and are as at be by for from in into is it its of on or over the their this
+    to toward towards under using via with within what how why""".split())
+# Stopwords that give the words after them a role: "impact of AI on climate" is not "impact of climate on AI"
+RELATION_WORDS = frozenset("""as at by for from in into of on over to toward towards under using via with
+    within""".split())
+
+class TopicIndex:
+    """Incremental TF-IDF index of topics with vectorized cosine search.
+
+    Terms are hashed into a fixed number of dimensions, so new topics never force a
+    vocabulary rebuild: adding one appends a row and bumps document frequencies. They are
+    the words after stopword removal and light stemming; each word tagged with its role;
+    adjacent word pairs within a phrase; and character 4-grams of the longer words, so
+    that "correction" and "correcting" overlap.
+
+    A word's role is the relation word before it ("of", "on", ...), or "head" in the
+    leading phrase. Possessives and leading modifiers count as "of", so "AI's impact on
+    climate change", "AI impact on climate change" and "impact of AI on climate change"
+    share every role, while "climate change impact on AI" shares almost none of them.
+    Role terms are counted twice so that such a reversal scores well below a paraphrase.
+
+    Search weights rows by IDF, normalizes, and takes one matrix-vector product. Topics
+    are only compared against entries generated with the same parameters.
+    """
+    def __init__(self, dimensions=4096):
+        self.dimensions = dimensions
+        self.lock = threading.Lock()
+        self.counts = np.zeros((64, dimensions), dtype=np.float32)
+        self.doc_freq = np.zeros(dimensions, dtype=np.float32)
+        self.size = 0
+        self.keys = {}
+        self.entries = []
+        self.weighted = None
+
+    def terms(self, topic):
+        words, roles, bigrams = [], [], []
+        role, previous = "head", None
+        for word, possessive in re.findall(r"(\w+)(['’]s\b)?", normalize_topic(topic)):
+            if word in RELATION_WORDS:
+                role, previous = word, None
+                continue
+            if word in STOPWORDS:
+                previous = None
+                continue
+            if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+                word = word[:-1]
+            words.append(word)
+            roles.append(("of" if possessive else role, word))
+            if previous is not None:
+                bigrams.append(f"{previous} {word}")
+            previous = None if possessive else word
+        # In "renewable energy storage" only the last word is the head, as in "storage of renewable energy"
+        heads = [i for i, (role, _) in enumerate(roles) if role == "head"]
+        for i in heads[:-1]:
+            roles[i] = ("of", roles[i][1])
+        roles = [f"{role}>{word}" for role, word in roles]
+        grams = [f"#{padded[i:i + 4]}" for padded in (f" {word} " for word in words if len(word) > 3)
+                 for i in range(len(padded) - 3)]
+        return words + roles + roles + bigrams + grams
+
+    def vector(self, topic):
+        vector = np.zeros(self.dimensions, dtype=np.float32)
+        for term in self.terms(topic):
+            vector[zlib.crc32(term.encode("utf-8")) % self.dimensions] += 1
+        nonzero = vector > 0
+        vector[nonzero] = 1 + np.log(vector[nonzero])
+        return vector
+
+    def add(self, key, topic, fingerprint):
+        vector = self.vector(topic)
+        with self.lock:
+            if key in self.keys:
+                return
+            if self.size == len(self.counts):
+                self.counts = np.vstack([self.counts, np.zeros_like(self.counts)])
+            self.counts[self.size] = vector
+            self.doc_freq += vector > 0
+            self.keys[key] = self.size
+            self.entries.append({'key': key, 'topic': topic, 'fingerprint': fingerprint})
+            self.size += 1
+            self.weighted = None
+
+    def remove(self, key):
+        """Stop matching a topic whose paper is no longer cached"""
+        with self.lock:
+            row = self.keys.pop(key, None)
+            if row is None:
+                return
+            self.doc_freq -= self.counts[row] > 0
+            self.counts[row] = 0
+            self.entries[row]['fingerprint'] = None
+            self.weighted = None
+
+    def search(self, topic, fingerprint):
+        """Best match as (entry, cosine similarity), or (None, 0.0) if there is none"""
+        query = self.vector(topic)
+        with self.lock:
+            if self.size == 0 or not query.any():
+                return None, 0.0
+            idf = np.log((1 + self.size) / (1 + self.doc_freq)) + 1
+            if self.weighted is None:
+                weighted = self.counts[:self.size] * idf
+                norms = np.linalg.norm(weighted, axis=1, keepdims=True)
+                self.weighted = weighted / np.maximum(norms, 1e-12)
+            query = query * idf
+            scores = self.weighted @ (query / max(np.linalg.norm(query), 1e-12))
+            allowed = np.array([entry['fingerprint'] == fingerprint for entry in self.entries])
+            scores = np.where(allowed, scores, -1.0)
+            best = int(np.argmax(scores))
+            if scores[best] <= 0:
+                return None, 0.0
+            return self.entries[best], float(scores[best])
+
+def params_fingerprint(params=None):
+    return cache_key("", params)
+
+topic_index = None
+topic_index_lock = threading.Lock()
+
+def get_topic_index():
+    """The semantic topic index, loaded from the paper store's topics on first use, or None when disabled"""
+    global topic_index
+    if not (ENABLE_CACHING and ENABLE_SEMANTIC_CACHE and np is not None):
+        return None
+    with topic_index_lock:
+        if topic_index is None:
+            index = TopicIndex()
+            for key, topic, fingerprint in paper_store.topics():
+                index.add(key, topic, fingerprint)
+            topic_index = index
+        return topic_index
+
+def index_topic(key, topic, fingerprint):
+    index = get_topic_index()
+    if index is not None:
+        index.add(key, topic, fingerprint)
+
+def similar_topic(topic, threshold, use):
+    """A cached topic at least `threshold` similar to this one, as (topic, key, score), or None"""
+    index = get_topic_index()
+    if index is None:
+        return None
+    entry, score = index.search(topic, params_fingerprint())
+    if entry is None or score < threshold:
+        metrics.inc("semantic_cache_requests_total", use=use, result="miss")
+        return None
+    metrics.inc("semantic_cache_requests_total", use=use, result="hit")
+    logger.info("Topic %r matches cached topic %r (similarity %.3f)", topic, entry['topic'], score)
+    return entry['topic'], entry['key'], score
+
+def _cached_entry(key):
+    entry = memory_cache.get(key)
+    metrics.inc("paper_cache_requests_total", tier="memory", result="miss" if entry is None else "hit")
+    if entry is None:
+        entry = paper_store.get(key)
+        metrics.inc("paper_cache_requests_total", tier="disk", result="miss" if entry is None else "hit")
+        if entry is None:
             return None
-    return None
+        memory_cache.put(key, entry, created=entry['created_at'])
+    return entry
+
+def get_cached_result(topic):
+    """Cached paper for a topic, checking memory, then disk, then near-duplicate topics, or None.
 
-def save_to_cache(topic, paper):
-    """Save paper to cache"""
+    Returns {'paper', 'paper_id', 'matched_topic', 'similarity'}; paper_id is the stored
+    paper's id, and the last two are None for an exact hit and name the cached topic that
+    was served instead, and its score, otherwise.
+    """
     if not ENABLE_CACHING:
-        return
-    topic_hash = str(hash(topic))
-    cache_file = os.path.join(CACHE_DIR, f"{topic_hash}.json")
+        return None
+    entry = _cached_entry(cache_key(topic))
+    if entry is not None:
+        return {'paper': entry['paper'], 'paper_id': entry['id'], 'matched_topic': None, 'similarity': None}
+    match = similar_topic(topic, SEMANTIC_PAPER_THRESHOLD, "paper")
+    while match is not None:
+        entry = _cached_entry(match[1])
+        if entry is not None:
+            break
+        # Gone from both tiers without an eviction callback (e.g. another process's store); try the next best
+        forget_cache_entry(match[1])
+        match = similar_topic(topic, SEMANTIC_PAPER_THRESHOLD, "paper")
+    if match is None:
+        return None
+    return {'paper': entry['paper'], 'paper_id': entry['id'], 'matched_topic': match[0],
+            'similarity': round(match[2], 3)}
+
+def save_to_cache(topic, paper, outline=None):
+    """Save paper, and the outline it was written from, to both cache tiers and the topic index.
+
+    Returns the stored paper's id, or None when caching is disabled.
+    """
+    if not ENABLE_CACHING:
+        return None
+    key = cache_key(topic)
+    params = generation_params()
+    fingerprint = params_fingerprint(params)
+    paper_id = paper_store.put(key, topic, paper, params, fingerprint, outline=outline)
+    now = time.time()
+    memory_cache.put(key, {'id': paper_id, 'topic': topic, 'paper': paper, 'params': params, 'created_at': now,
+                           'timestamp': datetime.fromtimestamp(now).isoformat()}, created=now)
+    index_topic(key, topic, fingerprint)
+    return paper_id
+
+def migrate_json_cache():
+    """Move papers from the old one-JSON-file-per-topic layout in CACHE_DIR into the paper store.
+
+    Runs in a single pass at startup: every cached paper is inserted (keeping its key
+    when it has a content-addressed name, re-keying it under the current parameters
+    when it has an old hash(topic) name) and then deleted. Other files are left alone.
+    """
+    migrated = 0
+    for item in os.scandir(CACHE_DIR):
+        stem, ext = os.path.splitext(item.name)
+        if not item.is_file() or ext != '.json':
+            continue
+        try:
+            with open(item.path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+            if entry.get('topic') and entry.get('paper'):
+                if re.fullmatch(r'[0-9a-f]{64}', stem) and entry.get('params'):
+                    key, params = stem, entry['params']
+                else:
+                    key, params = cache_key(entry['topic']), generation_params()
+                paper_store.put(key, entry['topic'], entry['paper'], params, params_fingerprint(params),
+                                created_at=entry.get('created') or item.stat().st_mtime)
+                os.remove(item.path)
+                migrated += 1
+        except Exception as e:
+            logger.warning("Cache migration error for %s: %s", item.name, e)
+    sidecar = os.path.join(CACHE_DIR, "topics.jsonl")
+    if os.path.exists(sidecar):
+        os.remove(sidecar)
+    if migrated:
+        logger.info("Migrated %d cached papers into %s", migrated, PAPER_DB)
+
+if ENABLE_CACHING:
+    migrate_json_cache()
+
+def stage_key(stage, inputs, params=None):
+    """Checkpoint key for a stage: a hash of the stage name, its inputs and the generation parameters"""
+    raw = json.dumps({'stage': stage, 'inputs': inputs, 'params': params or generation_params()}, sort_keys=True)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+def run_stage(stage, inputs, compute):
+    """Return the checkpointed output of a stage for these inputs, or compute and checkpoint it.
+
+    Empty outputs are treated as failures and never checkpointed.
+    """
+    key = stage_key(stage, inputs) if ENABLE_CACHING else None
+    if key is not None:
+        entry = stage_cache.get(key)
+        if entry is not None:
+            metrics.inc("paper_stage_runs_total", stage=stage, outcome="checkpoint")
+            logger.info("stage=%s outcome=checkpoint", stage)
+            return entry['output']
+    started = time.monotonic()
+    output = None
     try:
-        with open(cache_file, 'w', encoding='utf-8') as f:
-            json.dump({'topic': topic, 'paper': paper, 'timestamp': datetime.now().isoformat()}, f, ensure_ascii=False)
-    except Exception as e:
-        print(f"Cache write error: {str(e)}")
+        output = compute()
+    finally:
+        seconds = time.monotonic() - started
+        outcome = "ok" if output else "failed"
+        metrics.inc("paper_stage_runs_total", stage=stage, outcome=outcome)
+        metrics.observe("paper_stage_duration_seconds", seconds, stage=stage, outcome=outcome)
+        logger.info("stage=%s outcome=%s seconds=%.2f", stage, outcome, seconds)
+    if output and key is not None:
+        stage_cache.put(key, {'stage': stage, 'output': output})
+    return output
+
+def similar_outline(topic):
+    """The checkpointed outline of a sufficiently similar cached topic, retargeted at this topic, or None.
+
+    Later stages see only the outline, so the reused one is retitled and told what the
+    new topic adds; otherwise the paper would be written for the matched topic again.
+    """
+    match = similar_topic(topic, SEMANTIC_OUTLINE_THRESHOLD, "outline")
+    if match is None:
+        return None
+    entry = stage_cache.get(stage_key("outline", [normalize_topic(match[0])]))
+    if not entry or not isinstance(entry['output'], dict):
+        return None
+    outline = dict(entry['output'])
+    outline['title'] = topic
+    outline['topic'] = topic
+    outline['scope'] = (f"This outline was planned for the related topic '{match[0]}'. The paper is about '{topic}': "
+                        f"adapt the title, abstract and every section to that exact topic.")
+    return outline
+
+def get_research_outline(topic, on_token=None):
+    """Research outline for a topic, reusing a checkpoint, or a near-duplicate topic's outline, when one exists"""
+    return run_stage("outline", [normalize_topic(topic)],
+                     lambda: similar_outline(topic) or generate_research_outline(topic, on_token=on_token))
+
+def get_latex_template(outline, on_token=None):
+    """LaTeX template for an outline, reusing a checkpoint when one exists"""
+    return run_stage("template", [outline], lambda: generate_latex_template(outline, on_token=on_token))
+
+def get_paper_content(outline, latex_template, on_token=None):
+    """Paper LaTeX for an outline and template, reusing a checkpoint when one exists"""
+    if GENERATION_MODE == "sections":
+        generate = generate_paper_content_sections
+    else:
+        generate = generate_paper_content
+    return run_stage("content", [outline, latex_template],
+                     lambda: generate(outline, latex_template, on_token=on_token))
+
+def generate_research_paper(topic, on_stage=None, on_token=None, on_outline=None, on_skip=None):
+    """Generate research paper using direct API calls
 
-def generate_research_paper(topic):
-    """Generate research paper using direct API calls"""
-    outline = generate_research_outline(topic)
+    Each stage's output is checkpointed under a key derived from its inputs, so rerunning
+    a topic after a failure resumes from the last stage that completed.
+    on_stage, if given, is called with the name of each stage in STAGES as it starts.
+    on_token, if given, is called with each piece of text as the model streams it, and
+    with None when the text streamed so far in the current stage should be discarded.
+    Stages that make concurrent calls (sections, diagrams, polish) also pass part=<id>,
+    naming the call the text belongs to; None with a part discards only that part's text.
+    on_outline, if given, is called with the outline the paper is written from.
+    When citations, diagrams or polish fails, the previous stage's output is returned
+    instead and on_skip, if given, is called with the failed stage's name.
+    """
+    def report(stage):
+        if on_stage:
+            on_stage(stage)
+
+    def skip(stage, paper):
+        logger.warning("Stage %s failed; returning the paper without it", stage)
+        if on_skip:
+            on_skip(stage)
+        return paper
+    report("outline")
+    outline = get_research_outline(topic, on_token=on_token)
     if not outline:
         raise Exception("Failed to generate research outline")
-    latex_template = generate_latex_template(outline)
+    if on_outline:
+        on_outline(outline)
+    report("template")
+    latex_template = get_latex_template(outline, on_token=on_token)
     if not latex_template:
         raise Exception("Failed to generate LaTeX template")
-    paper_content = generate_paper_content(outline, latex_template)
+    report("content")
+    paper_content = get_paper_content(outline, latex_template, on_token=on_token)
     if not paper_content:
         raise Exception("Failed to generate paper content")
-    paper_with_citations = enhance_citations(paper_content)
+    report("citations")
+    paper_with_citations = run_stage("citations", [paper_content],
+                                     lambda: enhance_citations(paper_content, on_token=on_token))
     if not paper_with_citations:
-        return paper_content
-    paper_with_diagrams = enhance_diagrams(paper_with_citations)
+        return skip("citations", paper_content)
+    report("diagrams")
+    paper_with_diagrams = run_stage("diagrams", [paper_with_citations],
+                                    lambda: enhance_diagrams(paper_with_citations, on_token=on_token))
     if not paper_with_diagrams:
-        return paper_with_citations
-    final_paper = final_polish(paper_with_diagrams)
+        return skip("diagrams", paper_with_citations)
+    report("polish")
+    final_paper = run_stage("polish", [paper_with_diagrams],
+                            lambda: final_polish(paper_with_diagrams, on_token=on_token))
     if not final_paper:
-        return paper_with_diagrams
+        return skip("polish", paper_with_diagrams)
     return final_paper
 
-def call_openrouter_api(messages, temperature=0.7, max_tokens=4000):
-    """Make a direct call to the OpenRouter API with improved error handling"""
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-        "HTTP-Referer": "http://localhost:5000",
-        "X-Title": "Research Paper Generator"
-    }
+class SingleFlight:
+    """Collapse concurrent calls that share a key into a single execution.
+
+    The first caller for a key (the leader) runs the function; callers arriving while it
+    runs wait for and share its result, or re-raise its exception. A follower that times
+    out gives up alone and leaves the leader running.
+    """
+    def __init__(self):
+        self.flights = {}
+        self.lock = threading.Lock()
+
+    def do(self, key, fn, timeout=None, on_follow=None):
+        """Run fn once per in-flight key. Returns (result, shared), shared being True for followers."""
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = {'done': threading.Event(), 'result': None, 'error': None}
+                self.flights[key] = flight
+        if leader:
+            try:
+                flight['result'] = fn()
+            except BaseException as e:
+                flight['error'] = e
+                raise
+            finally:
+                with self.lock:
+                    del self.flights[key]
+                flight['done'].set()
+            return flight['result'], False
+        if on_follow:
+            on_follow()
+        if not flight['done'].wait(timeout):
+            raise TimeoutError(f"Timed out after {timeout}s waiting for an identical generation in progress")
+        if flight['error'] is not None:
+            raise flight['error']
+        return flight['result'], True
+
+paper_flights = SingleFlight()
+
+def generate_paper_cached(topic, on_stage=None, on_token=None, on_follow=None):
+    """Return (result, cached) for a topic, generating and caching the paper if needed.
+
+    result is shaped like get_cached_result()'s. Concurrent calls for the same cache key
+    share one pipeline run; on_follow is called when this call joins a run that another
+    caller already started. A paper returned without one of its finishing stages is not
+    cached, and its paper_id is None.
+    """
+    result = get_cached_result(topic)
+    if result:
+        return result, True
+
+    def generate():
+        # A run for this key may have finished between our cache miss and taking the lead
+        result = get_cached_result(topic)
+        if result:
+            return result
+        started = time.monotonic()
+        outline, skipped = [], []
+        paper = generate_research_paper(topic, on_stage=on_stage, on_token=on_token, on_outline=outline.append,
+                                        on_skip=skipped.append)
+        metrics.observe("paper_generation_duration_seconds", time.monotonic() - started)
+        # A paper missing a stage is not cached, so the next request reruns just that stage from the checkpoints
+        paper_id = None if skipped else save_to_cache(topic, paper, outline[0] if outline else None)
+        return {'paper': paper, 'paper_id': paper_id, 'matched_topic': None, 'similarity': None}
+
+    def follow():
+        metrics.inc("paper_generations_coalesced_total")
+        if on_follow:
+            on_follow()
+
+    result, _ = paper_flights.do(cache_key(topic), generate, timeout=SINGLE_FLIGHT_TIMEOUT, on_follow=follow)
+    return result, False
+
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+class RequestCancelled(Exception):
+    """Raised inside an OpenRouter call that was cancelled, e.g. a losing hedge"""
+
+def abort_response(response):
+    """Close a streaming response from another thread, waking a reader blocked on its socket"""
+    sock = getattr(getattr(response.raw, "connection", None), "sock", None)
+    if sock is None:
+        # http.client hands the socket over to the response when the server closes the connection
+        fp = getattr(getattr(response.raw, "_fp", None), "fp", None)
+        sock = getattr(getattr(fp, "raw", None), "_sock", None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+class Cancellation:
+    """Cancel signal for one in-flight OpenRouter call.
+
+    cancel() also shuts down the socket of the response being read, so the call ends at
+    once instead of when the server next sends data or finishes. A call still waiting for
+    response headers is abandoned as soon as they arrive.
+    """
+    def __init__(self):
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.response = None
+
+    def is_set(self):
+        return self.event.is_set()
+
+    def wait(self, timeout):
+        return self.event.wait(timeout)
+
+    def cancel(self):
+        with self.lock:
+            self.event.set()
+            response = self.response
+        if response is not None:
+            abort_response(response)
+
+    def attach(self, response):
+        with self.lock:
+            self.response = response
+            cancelled = self.event.is_set()
+        if cancelled:
+            abort_response(response)
+
+    def detach(self):
+        with self.lock:
+            self.response = None
+
+class RetryableAPIError(Exception):
+    """A failed OpenRouter call that is worth retrying, optionally after a server-given delay"""
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+def parse_retry_after(value):
+    """Seconds to wait from a Retry-After header (delta-seconds or HTTP-date), or None"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+def backoff_delay(attempt, retry_after=None):
+    """Exponential backoff with full jitter, never shorter than the server's Retry-After"""
+    delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_DELAY * 2 ** attempt))
+    if retry_after is not None:
+        delay = max(delay, min(retry_after, RETRY_MAX_DELAY))
+    return delay
+
+class TokenBucket:
+    """Thread-safe token bucket: allows `rate` acquisitions per second with bursts up to `capacity`"""
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = max(1, capacity)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class OpenRouterClient:
+    """Shared OpenRouter client: keep-alive connection pool, global concurrency and rate
+    limits, and retries with jittered exponential backoff that honor Retry-After.
+
+    A 429 pauses every caller of the client, not just the one that received it, so a
+    burst of workers backs off together instead of hammering the rate limit.
+    """
+    def __init__(self, url=OPENROUTER_API_URL, api_key=OPENROUTER_API_KEY, max_retries=MAX_RETRIES,
+                 timeout=(OPENROUTER_CONNECT_TIMEOUT, OPENROUTER_READ_TIMEOUT), pool_size=OPENROUTER_POOL_SIZE,
+                 max_concurrency=OPENROUTER_MAX_CONCURRENCY, rate_limit=OPENROUTER_RATE_LIMIT,
+                 rate_burst=OPENROUTER_RATE_BURST):
+        self.url = url
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {api_key}",
+            "HTTP-Referer": "http://localhost:5000",
+            "X-Title": "Research Paper Generator"
+        })
+        self.slots = threading.BoundedSemaphore(max_concurrency)
+        self.bucket = TokenBucket(rate_limit, rate_burst) if rate_limit > 0 else None
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def pause(self, seconds):
+        """Hold back all new requests for at least `seconds`"""
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def wait_until_unpaused(self):
+        """Block while a Retry-After pause is in effect"""
+        while True:
+            with self.lock:
+                remaining = self.paused_until - time.monotonic()
+            if remaining <= 0:
+                return
+            time.sleep(remaining)
+
+    def wait_for_capacity(self):
+        self.wait_until_unpaused()
+        if self.bucket:
+            self.bucket.acquire()
+
+    def _send(self, payload, on_token, cancel=None, hedge=False):
+        """One HTTP attempt. Returns (completion text, usage dict or None).
+
+        Hedges do not wait for a concurrency slot: they exist to beat a slow call, and
+        queueing them behind the calls they are hedging would defeat that.
+        """
+        with nullcontext() if hedge else self.slots:
+            response = self.session.post(self.url, json=payload, stream=True, timeout=self.timeout)
+            if cancel is not None:
+                cancel.attach(response)
+            try:
+                with response:
+                    result = self._read(response, payload.get("stream"), on_token, cancel)
+            except Exception:
+                if cancel is not None and cancel.is_set():
+                    raise RequestCancelled() from None
+                raise
+            finally:
+                if cancel is not None:
+                    cancel.detach()
+            if cancel is not None and cancel.is_set():
+                # An aborted stream can end without an error; its text is incomplete
+                raise RequestCancelled()
+            return result
+
+    @staticmethod
+    def _read(response, stream, on_token, cancel):
+        if response.status_code in RETRYABLE_STATUS_CODES:
+            raise RetryableAPIError(f"HTTP {response.status_code}: {response.text[:500]}",
+                                    parse_retry_after(response.headers.get("Retry-After")))
+        if not response.ok:
+            response.content  # read the error body for logging before the response is closed
+        response.raise_for_status()
+        if stream:
+            return read_openrouter_stream(response, on_token, cancel)
+        try:
+            data = response.json()
+        except ValueError as e:
+            raise RetryableAPIError(f"Error parsing JSON: {e}")
+        if "error" in data:
+            error = data["error"]
+            if isinstance(error, dict) and error.get("code") in RETRYABLE_STATUS_CODES:
+                raise RetryableAPIError(f"OpenRouter error: {error.get('message', error)}")
+            raise Exception(f"OpenRouter error: {error}")
+        return data["choices"][0]["message"]["content"], data.get("usage")
+
+    def chat(self, payload, on_token=None, stage=None, cancel=None, hedge=False):
+        """POST a chat completion payload and return the completion text.
+
+        Streaming payloads pass each text delta to on_token, if given. stage labels the
+        request's metrics (latency, retries, token usage). Cancelling `cancel` (a
+        Cancellation) ends the call with RequestCancelled, mid-response or between retries.
+        hedge marks a duplicate of a slow call, which skips the concurrency limit.
+        If a streamed attempt fails after producing output, on_token(None) is called before
+        the retry so the caller can discard the partial text.
+        """
+        stage = stage or "other"
+        streamed = [False]
+
+        def forward(text):
+            if text is not None:
+                streamed[0] = True
+            on_token(text)
+
+        for attempt in range(self.max_retries):
+            self.wait_for_capacity()
+            if cancel is not None and cancel.is_set():
+                raise RequestCancelled()
+            started = time.monotonic()
+            try:
+                text, usage = self._send(payload, forward if on_token else None, cancel, hedge)
+                metrics.inc("openrouter_requests_total", stage=stage, result="ok")
+                metrics.observe("openrouter_request_duration_seconds", time.monotonic() - started,
+                                stage=stage, model=payload.get("model", ""))
+                if usage:
+                    metrics.inc("openrouter_tokens_total", usage.get("prompt_tokens", 0), stage=stage, kind="prompt")
+                    metrics.inc("openrouter_tokens_total", usage.get("completion_tokens", 0), stage=stage, kind="completion")
+                return text
+            except (RetryableAPIError, requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+                metrics.inc("openrouter_requests_total", stage=stage, result="retryable_error")
+                logger.warning("API call error (stage=%s attempt %d/%d): %s", stage, attempt + 1, self.max_retries, e)
+                if attempt == self.max_retries - 1:
+                    raise Exception(f"OpenRouter API error after {self.max_retries} attempts: {e}")
+                retry_after = getattr(e, "retry_after", None)
+                delay = backoff_delay(attempt, retry_after)
+                if retry_after is not None:
+                    self.pause(delay)
+                metrics.inc("openrouter_retries_total", stage=stage)
+                if streamed[0]:
+                    streamed[0] = False
+                    on_token(None)
+                if cancel is not None and cancel.wait(delay):
+                    raise RequestCancelled()
+                if cancel is None:
+                    time.sleep(delay)
+            except requests.exceptions.HTTPError as e:
+                metrics.inc("openrouter_requests_total", stage=stage, result="error")
+                logger.error("API call error (stage=%s): %s; response: %s", stage, e, e.response.text)
+                raise Exception(f"OpenRouter API error: {e}")
+
+openrouter_client = OpenRouterClient()
+
+def read_openrouter_stream(response, on_token, cancel=None):
+    """Consume an OpenRouter server-sent event stream, passing each content delta to on_token.
+
+    Returns (completion text, usage dict or None); usage arrives in the final chunk.
+    Raises RequestCancelled as soon as cancel is set.
+    """
+    response.encoding = 'utf-8'
+    parts = []
+    usage = None
+    for line in response.iter_lines(decode_unicode=True):
+        if cancel is not None and cancel.is_set():
+            raise RequestCancelled()
+        # Blank lines separate events; lines starting with ':' are keep-alive comments
+        if not line or line.startswith(':') or not line.startswith('data:'):
+            continue
+        data = line[len('data:'):].strip()
+        if data == '[DONE]':
+            break
+        chunk = json.loads(data)
+        if 'error' in chunk:
+            raise Exception(f"OpenRouter stream error: {chunk['error'].get('message', chunk['error'])}")
+        usage = chunk.get("usage") or usage
+        choices = chunk.get("choices") or [{}]
+        delta = choices[0].get("delta", {}).get("content")
+        if delta:
+            parts.append(delta)
+            if on_token:
+                on_token(delta)
+    return "".join(parts), usage
+
+class CircuitBreaker:
+    """Per-model consecutive failure counts; a model at the threshold is skipped until its cooldown ends.
+
+    After the cooldown the model gets calls again, and one more failure reopens the circuit.
+    """
+    def __init__(self, threshold=CIRCUIT_FAILURES, cooldown=CIRCUIT_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = {}
+        self.open_until = {}
+        self.lock = threading.Lock()
+
+    def available(self, model):
+        with self.lock:
+            return time.monotonic() >= self.open_until.get(model, 0.0)
+
+    def success(self, model):
+        with self.lock:
+            self.failures[model] = 0
+            self.open_until.pop(model, None)
+        metrics.set("model_circuit_open", 0, model=model)
+
+    def failure(self, model):
+        with self.lock:
+            self.failures[model] = self.failures.get(model, 0) + 1
+            if self.failures[model] < self.threshold:
+                return
+            self.open_until[model] = time.monotonic() + self.cooldown
+        metrics.set("model_circuit_open", 1, model=model)
+        logger.warning("Circuit open for model %s for %.0fs", model, self.cooldown)
+
+class ModelRouter:
+    """Routes each call across the stage's ordered models with hedging and fallback.
+
+    The first model is tried alone. If it has not finished after the observed
+    HEDGE_QUANTILE duration of calls for that stage and model, the next model gets the
+    same request as a hedge. The first attempt to finish wins, and only then are the
+    others cancelled. A failed model hands the call to the next one, and models whose
+    circuit is open are skipped.
+
+    Every attempt is streamed from OpenRouter, so a losing one can be abandoned
+    mid-response. on_token follows one attempt at a time: the first to produce output,
+    replaced (after on_token(None)) if that attempt fails or another one wins.
+    """
+    def __init__(self, breaker=None, quantile=HEDGE_QUANTILE, min_samples=HEDGE_MIN_SAMPLES,
+                 window=HEDGE_WINDOW, hedging=ENABLE_HEDGING):
+        self.breaker = breaker or CircuitBreaker()
+        self.quantile = quantile
+        self.min_samples = min_samples
+        self.window = window
+        self.hedging = hedging
+        self.latencies = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def models(stage):
+        return STAGE_MODELS.get(stage) or [LLM_MODEL_NAME] + FALLBACK_MODELS
+
+    def record_latency(self, stage, model, seconds):
+        with self.lock:
+            samples = self.latencies.setdefault((stage, model), deque(maxlen=self.window))
+            samples.append(seconds)
+
+    def hedge_delay(self, stage, model):
+        """Seconds to wait on a model before hedging, or None until enough latencies are observed"""
+        with self.lock:
+            samples = sorted(self.latencies.get((stage, model), ()))
+        if len(samples) < self.min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(self.quantile * len(samples)))]
+
+    def chat(self, payload, on_token=None, stage=None):
+        """Send payload (its model is replaced per attempt) and return the winning completion text"""
+        stage = stage or "other"
+        configured = self.models(stage)
+        # An all-open breaker must not make the stage unusable; try every model anyway
+        models = [m for m in configured if self.breaker.available(m)] or configured
+        payload = dict(payload, stream=True, usage={"include": True})
+        results = queue.Queue()
+        attempts = []
+        lock = threading.Lock()
+        shown = [None]  # index of the attempt whose text on_token is following
+
+        def show(index):
+            """Make on_token follow attempt `index` (or none), replaying its text so far. Caller holds lock."""
+            if shown[0] == index:
+                return
+            if shown[0] is not None and attempts[shown[0]]['parts']:
+                on_token(None)
+            shown[0] = index
+            if index is not None and attempts[index]['parts']:
+                on_token("".join(attempts[index]['parts']))
+
+        def launch(index, hedge):
+            """Start an attempt on models[index]; returns when to hedge it, or None"""
+            attempt = {'model': models[index], 'cancel': Cancellation(), 'parts': [], 'hedge': hedge, 'done': False}
+            with lock:
+                attempts.append(attempt)
+            started = time.monotonic()
+
+            def receive(token):
+                with lock:
+                    if token is None:
+                        # The client is retrying this attempt from the start
+                        if shown[0] == index and attempt['parts']:
+                            on_token(None)
+                        attempt['parts'] = []
+                        return
+                    attempt['parts'].append(token)
+                    if shown[0] is None:
+                        show(index)
+                    elif shown[0] == index:
+                        on_token(token)
+
+            def run():
+                try:
+                    text = openrouter_client.chat(dict(payload, model=attempt['model']), receive if on_token else None,
+                                                  stage=stage, cancel=attempt['cancel'], hedge=hedge)
+                    self.record_latency(stage, attempt['model'], time.monotonic() - started)
+                    results.put((index, text, None))
+                except Exception as e:
+                    results.put((index, None, e))
+
+            threading.Thread(target=run, name=f"openrouter-{stage}-{index}", daemon=True).start()
+            delay = self.hedge_delay(stage, attempt['model']) if self.hedging and index + 1 < len(models) else None
+            return started + delay if delay is not None else None
+
+        def count_hedges(winner):
+            for index, attempt in enumerate(attempts):
+                if attempt['hedge']:
+                    metrics.inc("openrouter_hedges_total", stage=stage, result="won" if index == winner else "lost")
+
+        latest = 0
+        deadline = launch(0, hedge=False)
+        running = 1
+        error = None
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                index, text, failure = results.get(timeout=timeout)
+            except queue.Empty:
+                latest += 1
+                logger.info("Hedging %s call on %s: %s is slower than its p%d latency", stage, models[latest],
+                            models[latest - 1], round(self.quantile * 100))
+                deadline = launch(latest, hedge=True)
+                running += 1
+                continue
+            running -= 1
+            with lock:
+                attempts[index]['done'] = True
+            if failure is None:
+                self.breaker.success(models[index])
+                with lock:
+                    if on_token:
+                        show(index)
+                for other, attempt in enumerate(attempts):
+                    if other != index:
+                        attempt['cancel'].cancel()
+                count_hedges(index)
+                return text
+            if not isinstance(failure, RequestCancelled):
+                error = failure
+                self.breaker.failure(models[index])
+            with lock:
+                if on_token and shown[0] == index:
+                    # Follow the running attempt that has produced the most output, if any
+                    others = [i for i, attempt in enumerate(attempts) if not attempt['done']]
+                    show(max(others, key=lambda i: len(attempts[i]['parts'])) if others else None)
+            if running > 0:
+                continue
+            if latest + 1 >= len(models):
+                count_hedges(None)
+                raise error or Exception(f"Every model failed for stage {stage}")
+            latest += 1
+            metrics.inc("openrouter_fallbacks_total", stage=stage)
+            logger.warning("Falling back to %s for %s after %s failed: %s", models[latest], stage,
+                           models[index], error)
+            deadline = launch(latest, hedge=False)
+            running += 1
+
+model_router = ModelRouter()
+
+def part_tokens(on_token, part):
+    """on_token for one of several concurrent calls, tagging its text with `part` so interleaved output stays apart"""
+    if on_token is None:
+        return None
+    return lambda text: on_token(text, part=part)
+
+def call_openrouter_api(messages, temperature=0.7, max_tokens=4000, on_token=None, stage=None):
+    """Make a call to the OpenRouter API through the model router and the shared pooled client
+
+    The completion is always streamed; when on_token is given it receives each text delta.
+    on_token(None) means the text streamed so far is void, because the call is being
+    retried or handed to another model, and the completion will be streamed again.
+    stage names the pipeline stage making the call; it selects the models to try and labels metrics.
+    """
     payload = {
         "model": LLM_MODEL_NAME,
         "messages": messages,
         "temperature": temperature,
         "max_tokens": max_tokens
     }
-    for attempt in range(MAX_RETRIES):
-        try:
-            print(f"Sending payload: {json.dumps(payload, indent=2)}")
-            response = requests.post("https://openrouter.ai/api/v1/chat/completions", headers=headers, json=payload)
-            response.raise_for_status()
-            data = response.json()
-            return data["choices"][0]["message"]["content"]
-        except requests.exceptions.HTTPError as e:
-            print(f"API call error (attempt {attempt+1}/{MAX_RETRIES}): {e}")
-            print(f"Response content: {e.response.text}")
-            if attempt < MAX_RETRIES - 1:
-                time.sleep(RETRY_DELAY)
-            else:
-                raise Exception(f"OpenRouter API error after {MAX_RETRIES} attempts: {e}")
-        except json.JSONDecodeError as e:
-            print(f"JSON decode error: {e}")
-            print(f"Raw response: {response.text}")
-            raise Exception(f"Error parsing JSON: {e}")
-        except Exception as e:
-            print(f"General API error: {e}")
-            raise Exception(f"General API error: {e}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Sending payload: %s", json.dumps(payload, indent=2))
+    return model_router.chat(payload, on_token, stage=stage)
 
-def generate_research_outline(topic):
+def generate_research_outline(topic, on_token=None):
     """Generate research outline with direct API call"""
     prompt = f"You are a world-class academic researcher. Develop a comprehensive plan for a research paper on the topic: '{topic}'. Include title, abstract points, keywords, sections, diagrams, tables, mathematical areas, and key sources. Format as JSON."
     messages = [{"role": "system", "content": "You are a helpful research assistant."}, {"role": "user", "content": prompt}]
     try:
-        response = call_openrouter_api(messages)
+        response = call_openrouter_api(messages, on_token=on_token, stage="outline")
         import re
         json_match = re.search(r'```(?:json)?\s*([\s\S]*?)\s*```', response)
         if json_match:
@@ -124,16 +1496,16 @@ def generate_research_outline(topic):
         except:
             return {"raw_outline": response}
     except Exception as e:
-        print(f"Error generating research outline: {str(e)}")
+        logger.error("Error generating research outline: %s", e)
         return None
 
-def generate_latex_template(outline):
+def generate_latex_template(outline, on_token=None):
     """Generate LaTeX template with direct API call"""
     outline_str = json.dumps(outline, indent=2)
     prompt = f"You are an expert in LaTeX. Based on this research outline: {outline_str}, create a LaTeX template with document class, packages, styling, and bibliography style. Format as JSON."
     messages = [{"role": "system", "content": "You are a helpful LaTeX expert."}, {"role": "user", "content": prompt}]
     try:
-        response = call_openrouter_api(messages)
+        response = call_openrouter_api(messages, on_token=on_token, stage="template")
         import re
         json_match = re.search(r'```(?:json)?\s*([\s\S]*?)\s*```', response)
         if json_match:
@@ -146,274 +1518,963 @@ def generate_latex_template(outline):
         except:
             return {"raw_template": response}
     except Exception as e:
-        print(f"Error generating LaTeX template: {str(e)}")
+        logger.error("Error generating LaTeX template: %s", e)
         return None
 
-def generate_paper_content(outline, latex_template):
+def generate_paper_content(outline, latex_template, on_token=None):
     """Generate paper content with direct API call"""
     outline_str = json.dumps(outline, indent=2)
     template_str = json.dumps(latex_template, indent=2)
     prompt = f"You are a world-class academic researcher. Write a complete research paper based on this outline: {outline_str} and LaTeX template: {template_str}. Return ONLY the complete LaTeX code."
     messages = [{"role": "system", "content": "You are a helpful research paper writer."}, {"role": "user", "content": prompt}]
     try:
-        response = call_openrouter_api(messages, temperature=0.7, max_tokens=8000)
+        response = call_openrouter_api(messages, temperature=0.7, max_tokens=8000, on_token=on_token, stage="content")
         import re
         latex_match = re.search(r'```(?:latex)?\s*([\s\S]*?)\s*```', response)
         if latex_match:
             return latex_match.group(1).strip()
         return response
     except Exception as e:
-        print(f"Error generating paper content: {str(e)}")
+        logger.error("Error generating paper content: %s", e)
         return None
 
-def enhance_citations(paper_content):
-    """Enhance citations with direct API call"""
-    prompt = f"You are an expert in academic citation. Review this LaTeX paper: {paper_content} and enhance its citations and references. Return the complete LaTeX document."
-    messages = [{"role": "system", "content": "You are a helpful citation expert."}, {"role": "user", "content": prompt}]
+def extract_latex(response):
+    """LaTeX from a model response, unwrapping a fenced code block if there is one"""
+    latex_match = re.search(r'```(?:latex|tex)?\s*([\s\S]*?)\s*```', response)
+    if latex_match:
+        return latex_match.group(1).strip()
+    return response.strip()
+
+def outline_sections(outline):
+    """Planned sections of an outline as [{'title', 'plan'}], or [] if none can be found.
+
+    Outlines are free-form model JSON, so this looks for a 'sections' list at the top
+    level or one level down, and accepts plain strings or dicts with a title-like key.
+    """
+    if not isinstance(outline, dict):
+        return []
+    candidates = [outline] + [value for value in outline.values() if isinstance(value, dict)]
+    items = None
+    for candidate in candidates:
+        for key, value in candidate.items():
+            if key.lower() in ("sections", "paper_sections", "section_outline") and isinstance(value, list):
+                items = value
+                break
+        if items:
+            break
+    sections = []
+    for item in items or []:
+        if isinstance(item, str):
+            sections.append({'title': item, 'plan': ''})
+        elif isinstance(item, dict):
+            title_key = next((k for k in item if k.lower() in ("title", "name", "heading", "section", "section_title")), None)
+            if title_key is None or not isinstance(item[title_key], str):
+                continue
+            plan = {k: v for k, v in item.items() if k != title_key}
+            sections.append({'title': item[title_key], 'plan': json.dumps(plan) if plan else ''})
+    return sections
+
+def section_placeholder(index):
+    return f"%%SECTION {index + 1}%%"
+
+def generate_paper_skeleton(outline, latex_template, sections, on_token=None):
+    """Generate the paper frame (preamble, title, abstract, bibliography) with a placeholder per section"""
+    outline_str = json.dumps(outline, indent=2)
+    template_str = json.dumps(latex_template, indent=2)
+    placeholders = "\n".join(f"{section_placeholder(i)}  ({section['title']})" for i, section in enumerate(sections))
+    prompt = (f"You are a world-class academic researcher. Based on this outline: {outline_str} and LaTeX template: {template_str}, "
+              f"write the frame of the research paper: the full preamble with all packages and macro definitions, title, author, "
+              f"abstract and keywords, then exactly these placeholder lines in this order, each on its own line:\n{placeholders}\n"
+              f"Do NOT write the sections themselves. After the placeholders, write a thebibliography environment with the key sources "
+              f"and close the document. Return ONLY the LaTeX code.")
+    messages = [{"role": "system", "content": "You are a helpful research paper writer."}, {"role": "user", "content": prompt}]
     try:
-        response = call_openrouter_api(messages, temperature=0.7, max_tokens=8000)
-        import re
-        latex_match = re.search(r'```(?:latex)?\s*([\s\S]*?)\s*```', response)
-        if latex_match:
-            return latex_match.group(1).strip()
-        return response
+        response = call_openrouter_api(messages, temperature=0.7, max_tokens=SECTION_MAX_TOKENS, on_token=on_token,
+                                       stage="skeleton")
+        return extract_latex(response)
     except Exception as e:
-        print(f"Error enhancing citations: {str(e)}")
+        logger.error("Error generating paper skeleton: %s", e)
         return None
 
-def enhance_diagrams(paper_content):
-    """Enhance diagrams with direct API call"""
-    prompt = f"You are an expert in scientific visualization. Review this LaTeX paper: {paper_content} and enhance its diagrams and visualizations. Return the complete LaTeX document."
-    messages = [{"role": "system", "content": "You are a helpful visualization expert."}, {"role": "user", "content": prompt}]
+def paper_context(latex):
+    """Context every section shares: title, abstract, notation macros and citation keys"""
+    title = re.search(r'\\title\{(.*?)\}\s*$', latex, re.MULTILINE)
+    abstract = re.search(r'\\begin\{abstract\}([\s\S]*?)\\end\{abstract\}', latex)
+    notation = re.findall(r'^\s*\\(?:newcommand|renewcommand|DeclareMathOperator)\b.*$', latex, re.MULTILINE)
+    citation_keys = re.findall(r'\\bibitem(?:\[[^\]]*\])?\{([^}]*)\}', latex)
+    return {
+        'title': title.group(1).strip() if title else '',
+        'abstract': abstract.group(1).strip() if abstract else '',
+        'notation': "\n".join(line.strip() for line in notation),
+        'citation_keys': citation_keys,
+    }
+
+def generate_section(outline, sections, index, context, on_token=None, current=None, instructions=None):
+    """Generate the LaTeX for one section, given the context shared by the whole paper
+
+    With current (the section's existing LaTeX) the section is rewritten rather than
+    written from scratch, following instructions when they are given.
+    """
+    section = sections[index]
+    all_titles = "; ".join(f"{i + 1}. {s['title']}" for i, s in enumerate(sections))
+    revision = ""
+    if current and instructions:
+        revision = (f"This section already exists. Rewrite it following these instructions: {instructions}\n"
+                    f"Keep whatever the instructions do not ask to change. Current version:\n{current}\n")
+    elif current:
+        revision = f"This section already exists. Write an improved version of it. Current version:\n{current}\n"
+    prompt = (f"You are a world-class academic researcher writing one section of a research paper.\n"
+              f"Paper title: {context['title'] or outline.get('title', '')}\n"
+              f"Abstract: {context['abstract']}\n"
+              f"All sections: {all_titles}\n"
+              f"Notation macros already defined in the preamble:\n{context['notation'] or '(none)'}\n"
+              f"Citation keys available for \\cite: {', '.join(context['citation_keys']) or '(none)'}\n"
+              f"Write section {index + 1}, \"{section['title']}\", in full. Plan for this section: {section['plan'] or '(follow the title)'}\n"
+              f"{revision}"
+              f"Start with \\section{{{section['title']}}}. Do not repeat material that belongs to the other sections. "
+              f"Return ONLY the LaTeX for this section, without a preamble or \\begin{{document}}.")
+    messages = [{"role": "system", "content": "You are a helpful research paper writer."}, {"role": "user", "content": prompt}]
     try:
-        response = call_openrouter_api(messages, temperature=0.7, max_tokens=8000)
-        import re
-        latex_match = re.search(r'```(?:latex)?\s*([\s\S]*?)\s*```', response)
-        if latex_match:
-            return latex_match.group(1).strip()
-        return response
+        response = call_openrouter_api(messages, temperature=0.7, max_tokens=SECTION_MAX_TOKENS,
+                                       on_token=on_token, stage="section")
+        latex = extract_latex(response)
+        body = re.search(r'\\begin\{document\}([\s\S]*?)(?:\\end\{document\}|$)', latex)
+        if body:
+            latex = body.group(1).strip()
+        return latex
     except Exception as e:
-        print(f"Error enhancing diagrams: {str(e)}")
+        logger.error("Error generating section '%s': %s", section['title'], e)
         return None
 
-def final_polish(paper_content):
-    """Final polish with direct API call"""
-    prompt = f"You are a meticulous academic editor and LaTeX expert. Review this LaTeX paper: {paper_content} and perform final polishing. Return the complete, finalized LaTeX document."
-    messages = [{"role": "system", "content": "You are a helpful LaTeX editor."}, {"role": "user", "content": prompt}]
+# Where the body of a paper ends and its bibliography or closing matter begins
+BACK_MATTER_PATTERN = re.compile(r'\\begin\{thebibliography\}|\\bibliography\{|\\printbibliography|\\end\{document\}')
+
+def assemble_paper(skeleton, section_texts):
+    """Splice sections into their skeleton placeholders, placing any without one before the bibliography"""
+    unplaced = []
+    for index, text in enumerate(section_texts):
+        placeholder = re.compile(r'^.*' + re.escape(section_placeholder(index)) + r'.*$', re.MULTILINE)
+        if placeholder.search(skeleton):
+            skeleton = placeholder.sub(lambda _: text, skeleton, count=1)
+        else:
+            unplaced.append(text)
+    if unplaced:
+        tail = BACK_MATTER_PATTERN.search(skeleton)
+        position = tail.start() if tail else len(skeleton)
+        skeleton = skeleton[:position] + "\n\n".join(unplaced) + "\n\n" + skeleton[position:]
+    return skeleton
+
+def generate_paper_content_sections(outline, latex_template, on_token=None):
+    """Generate paper content section by section, concurrently, and assemble the result.
+
+    Wall-clock time is the skeleton call plus the slowest section rather than one call for
+    the whole paper, and paper length is no longer capped by a single completion's
+    max_tokens. Each section is checkpointed, so a failed section is the only one redone.
+    Falls back to generate_paper_content() when the outline has no usable sections.
+    """
+    sections = outline_sections(outline)
+    if not sections:
+        return generate_paper_content(outline, latex_template, on_token=on_token)
+    skeleton = run_stage("skeleton", [outline, latex_template],
+                         lambda: generate_paper_skeleton(outline, latex_template, sections, on_token=on_token))
+    if not skeleton:
+        return None
+    context = paper_context(skeleton)
+
+    def section_task(index):
+        return run_stage("section", [outline, skeleton, index],
+                         lambda: generate_section(outline, sections, index, context,
+                                                  on_token=part_tokens(on_token, f"section-{index + 1}")))
+
+    with ThreadPoolExecutor(max_workers=max(1, SECTION_WORKERS)) as pool:
+        section_texts = list(pool.map(section_task, range(len(sections))))
+    if not all(section_texts):
+        return None
+    return assemble_paper(skeleton, section_texts)
+
+def read_batch_topics(lines):
+    """Parse JSONL lines into batch records [{'id', 'topic'}].
+
+    The topic comes from a 'topic' field, falling back to 'title'; the id from 'id' or
+    'request_id', falling back to the topic's cache key. Unusable lines are skipped.
+    """
+    records = []
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            logger.warning("Skipping batch line %d: %s", number, e)
+            continue
+        topic = (record.get('topic') or record.get('title')) if isinstance(record, dict) else None
+        if not isinstance(topic, str) or not topic.strip():
+            logger.warning("Skipping batch line %d: no topic or title", number)
+            continue
+        topic = topic.strip()
+        record_id = str(record.get('id') or record.get('request_id') or cache_key(topic))
+        records.append({'id': record_id, 'topic': topic})
+    return records
+
+def read_batch_results(output_path):
+    """Results already written to a batch output file, keyed by record id (later lines win)"""
+    results = {}
+    if not os.path.exists(output_path):
+        return results
+    with open(output_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                continue  # a line cut short by a crash
+            results[result.get('id')] = result
+    return results
+
+def run_batch(records, output_path, concurrency=BATCH_CONCURRENCY, on_result=None):
+    """Generate a paper for each record, appending one JSON result per line to output_path.
+
+    Records that already have a completed result in output_path are skipped, so an
+    interrupted batch resumes where it stopped; topics already in the cache finish
+    without touching the model. At most `concurrency` topics run at once, and no new
+    topic starts while the OpenRouter client is paused by a 429 Retry-After.
+    Returns a summary of counts.
+    """
+    done = {record_id for record_id, result in read_batch_results(output_path).items()
+            if result.get('status') == 'completed'}
+    pending = [record for record in records if record['id'] not in done]
+    summary = {'total': len(records), 'skipped': len(records) - len(pending), 'completed': 0, 'failed': 0}
+    directory = os.path.dirname(output_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    write_lock = threading.Lock()
+    slots = threading.BoundedSemaphore(max(1, concurrency))
+
+    with open(output_path, 'a+', encoding='utf-8') as output:
+        # Terminate a partial last line left by a crash so new results start on their own line
+        if output.tell() > 0:
+            output.seek(output.tell() - 1)
+            if output.read(1) != '\n':
+                output.write('\n')
+
+        def process(record):
+            started = time.time()
+            try:
+                generated, cached = generate_paper_cached(record['topic'])
+                result = {'id': record['id'], 'topic': record['topic'], 'status': 'completed', 'cached': cached}
+                if generated['matched_topic']:
+                    result.update(matched_topic=generated['matched_topic'], similarity=generated['similarity'])
+                result['paper'] = generated['paper']
+            except Exception as e:
+                result = {'id': record['id'], 'topic': record['topic'], 'status': 'failed', 'error': str(e)}
+            finally:
+                slots.release()
+            result['seconds'] = round(time.time() - started, 3)
+            result['timestamp'] = datetime.now().isoformat()
+            with write_lock:
+                output.write(json.dumps(result, ensure_ascii=False) + '\n')
+                output.flush()
+                summary[result['status']] += 1
+            if on_result:
+                on_result(result)
+
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+            for record in pending:
+                slots.acquire()
+                openrouter_client.wait_until_unpaused()
+                pool.submit(process, record)
+    return summary
+
+def latex_environments(latex, names):
+    """(start, end) spans of every \\begin{name}...\\end{name} environment for the given names.
+
+    Matches do not overlap, so an environment nested in an earlier match (a tikzpicture
+    inside a figure, say) is covered by the outer span.
+    """
+    pattern = re.compile(r'\\begin\{(' + '|'.join(re.escape(name) for name in names) + r')\}[\s\S]*?\\end\{\1\}')
+    return [match.span() for match in pattern.finditer(latex)]
+
+def section_spans(latex):
+    """(start, end) spans of each \\section, running to the next one or to the back matter"""
+    starts = [match.start() for match in re.finditer(r'\\section\*?\{', latex)]
+    if not starts:
+        return []
+    back_matter = BACK_MATTER_PATTERN.search(latex, starts[-1])
+    ends = starts[1:] + [back_matter.start() if back_matter else len(latex)]
+    return list(zip(starts, ends))
+
+def splice_fragments(latex, spans, replacements):
+    """Replace each span with its replacement, leaving spans whose replacement is None untouched"""
+    for (start, end), replacement in sorted(zip(spans, replacements), reverse=True):
+        if replacement is not None:
+            latex = latex[:start] + replacement + latex[end:]
+    return latex
+
+def fragment_max_tokens(fragment):
+    """Completion budget for rewriting a fragment: roomy relative to its length (~4 chars per token)"""
+    return min(8000, max(1000, len(fragment) // 2))
+
+def rewrite_fragments(fragments, build_messages, accept, on_token=None, stage=None):
+    """Rewrite fragments concurrently, one model call each.
+
+    Returns a list holding the accepted rewrite for each fragment, or None where the
+    call failed or accept(original, rewrite) rejected the result (so the original
+    stays), or None overall if every call failed. Each call streams to on_token as its
+    own part.
+    """
+    errors = []
+
+    def rewrite(index):
+        fragment = fragments[index]
+        tokens = part_tokens(on_token, f"{stage or 'fragment'}-{index + 1}")
+        try:
+            response = call_openrouter_api(build_messages(fragment), temperature=0.7,
+                                           max_tokens=fragment_max_tokens(fragment), on_token=tokens, stage=stage)
+        except Exception as e:
+            errors.append(e)
+            logger.error("Error rewriting %s fragment: %s", stage or "paper", e)
+            return None
+        result = accept(fragment, extract_latex(response))
+        if result is None and tokens:
+            tokens(None)  # the original stays, so its streamed rewrite is void
+        return result
+
+    with ThreadPoolExecutor(max_workers=max(1, FRAGMENT_WORKERS)) as pool:
+        results = list(pool.map(rewrite, range(len(fragments))))
+    if fragments and len(errors) == len(fragments):
+        return None
+    return results
+
+def accept_environment(original, rewrite):
+    """The rewritten environment if the response contains one of the same kind as the original"""
+    name = re.match(r'\\begin\{([^}]*)\}', original).group(1)
+    spans = latex_environments(rewrite, [name])
+    if not spans:
+        return None
+    start, end = spans[0]
+    return rewrite[start:end]
+
+def preamble_packages(latex):
+    return ", ".join(re.findall(r'\\usepackage(?:\[[^\]]*\])?\{([^}]*)\}', latex))
+
+def cited_keys(latex):
+    keys = []
+    for group in re.findall(r'\\(?:cite|citep|citet|parencite|textcite|autocite)\*?(?:\[[^\]]*\])*\{([^}]*)\}', latex):
+        for key in group.split(','):
+            key = key.strip()
+            if key and key not in keys:
+                keys.append(key)
+    return keys
+
+BIBLIOGRAPHY_ENVIRONMENTS = ["thebibliography", "filecontents", "filecontents*"]
+
+def enhance_citations(paper_content, on_token=None):
+    """Enhance citations by rewriting only the bibliography, given every key the text cites"""
+    keys = cited_keys(paper_content)
+    spans = latex_environments(paper_content, BIBLIOGRAPHY_ENVIRONMENTS)
+    if not keys and not spans:
+        return paper_content
+    if spans:
+        bibliography = paper_content[spans[0][0]:spans[0][1]]
+        instruction = "Rewrite this bibliography environment"
+    else:
+        bibliography = ""
+        instruction = "Write a thebibliography environment"
+        if re.search(r'\\printbibliography|\\bibliography\{', paper_content):
+            # An external .bib file we cannot see; nothing to splice into
+            return paper_content
+    contexts = []
+    for match in re.finditer(r'\\(?:cite|citep|citet|parencite|textcite|autocite)\*?(?:\[[^\]]*\])*\{[^}]*\}', paper_content):
+        contexts.append(paper_content[max(0, match.start() - 150):match.end()].replace("\n", " "))
+        if len(contexts) >= 30:
+            break
+    context_str = "\n".join(f"- ...{context}" for context in contexts)
+    prompt = (f"You are an expert in academic citation. {instruction} so that it has a complete, accurate, consistently formatted "
+              f"entry for every one of these cited keys, keeping the keys unchanged: {', '.join(keys)}.\n"
+              f"The citations appear in these contexts:\n{context_str}\n"
+              f"{bibliography}\n"
+              f"Return ONLY the complete bibliography environment, of the same kind, and nothing else.")
+    messages = [{"role": "system", "content": "You are a helpful citation expert."}, {"role": "user", "content": prompt}]
     try:
-        response = call_openrouter_api(messages, temperature=0.7, max_tokens=8000)
-        import re
-        latex_match = re.search(r'```(?:latex)?\s*([\s\S]*?)\s*```', response)
-        if latex_match:
-            return latex_match.group(1).strip()
-        return response
+        response = call_openrouter_api(messages, temperature=0.7,
+                                       max_tokens=min(8000, max(fragment_max_tokens(bibliography), 200 * len(keys))),
+                                       on_token=on_token, stage="citations")
     except Exception as e:
-        print(f"Error in final polish: {str(e)}")
+        logger.error("Error enhancing citations: %s", e)
+        return None
+    rewrite = extract_latex(response)
+    if spans:
+        replacement = accept_environment(bibliography, rewrite)
+        if replacement is None or any(key not in replacement for key in keys):
+            return paper_content
+        return splice_fragments(paper_content, spans[:1], [replacement])
+    new_spans = latex_environments(rewrite, ["thebibliography"])
+    if not new_spans:
+        return paper_content
+    end_document = paper_content.rfind("\\end{document}")
+    position = end_document if end_document != -1 else len(paper_content)
+    replacement = rewrite[new_spans[0][0]:new_spans[0][1]] + "\n\n"
+    return paper_content[:position] + replacement + paper_content[position:]
+
+def enhance_diagrams(paper_content, on_token=None):
+    """Enhance each figure, table and TikZ picture concurrently, splicing the results back in"""
+    spans = latex_environments(paper_content, ["figure", "figure*", "table", "table*", "tikzpicture"])
+    if not spans:
+        return paper_content
+    packages = preamble_packages(paper_content)
+
+    def build_messages(fragment):
+        prompt = (f"You are an expert in scientific visualization. Improve this LaTeX environment from a research paper: make it "
+                  f"clearer, more informative and correct, keeping its \\label and caption meaning. Only these packages are "
+                  f"loaded: {packages}.\n{fragment}\n"
+                  f"Return ONLY the improved environment, of the same kind, and nothing else.")
+        return [{"role": "system", "content": "You are a helpful visualization expert."}, {"role": "user", "content": prompt}]
+
+    fragments = [paper_content[start:end] for start, end in spans]
+    replacements = rewrite_fragments(fragments, build_messages, accept_environment, on_token=on_token, stage="diagrams")
+    if replacements is None:
+        return None
+    return splice_fragments(paper_content, spans, replacements)
+
+def final_polish(paper_content, on_token=None):
+    """Polish the abstract and each section concurrently, splicing the results back in.
+
+    A rewrite much shorter than its original is taken as truncated and discarded.
+    """
+    spans = section_spans(paper_content)
+    abstract = latex_environments(paper_content, ["abstract"])[:1]
+    if abstract and (not spans or abstract[0][1] <= spans[0][0]):
+        spans = abstract + spans
+    if not spans:
+        return paper_content
+    title = re.search(r'\\title\{(.*?)\}\s*$', paper_content, re.MULTILINE)
+    title = title.group(1).strip() if title else "(untitled)"
+
+    def build_messages(fragment):
+        prompt = (f"You are a meticulous academic editor and LaTeX expert. This is one part of the research paper \"{title}\". "
+                  f"Polish it: fix grammar, clarity, flow and LaTeX errors, keeping every \\label, \\ref, \\cite key, "
+                  f"equation and environment.\n{fragment}\n"
+                  f"Return ONLY the polished LaTeX for this part, starting exactly as it starts now.")
+        return [{"role": "system", "content": "You are a helpful LaTeX editor."}, {"role": "user", "content": prompt}]
+
+    def accept(original, rewrite):
+        if len(rewrite) < 0.6 * len(original):
+            return None
+        if original.startswith("\\begin{abstract}"):
+            return accept_environment(original, rewrite)
+        if not rewrite.startswith("\\section"):
+            return None
+        return rewrite + "\n\n"
+
+    fragments = [paper_content[start:end] for start, end in spans]
+    replacements = rewrite_fragments(fragments, build_messages, accept, on_token=on_token, stage="polish")
+    if replacements is None:
         return None
+    return splice_fragments(paper_content, spans, replacements)
+
+SECTION_TITLE_PATTERN = re.compile(r'\\section\*?\{([^}]*)\}')
+
+def find_section(titles, section=None, instructions=None):
+    """Index of the section to regenerate: by number or title, else the one the instructions name"""
+    if section is not None:
+        section = str(section).strip()
+        if section.isdigit() and 1 <= int(section) <= len(titles):
+            return int(section) - 1
+        wanted = normalize_topic(section)
+        normalized = [normalize_topic(title) for title in titles]
+        if wanted in normalized:
+            return normalized.index(wanted)
+        partial = [i for i, title in enumerate(normalized) if wanted in title]
+        if len(partial) == 1:
+            return partial[0]
+        raise ValueError(f"No single section matches {section!r}; sections are: {', '.join(titles)}")
+    mentioned = [i for i, title in enumerate(titles) if title and normalize_topic(title) in normalize_topic(instructions)]
+    if not mentioned:
+        raise ValueError(f"Name the section to regenerate; sections are: {', '.join(titles)}")
+    return max(mentioned, key=lambda i: len(titles[i]))
+
+def regenerate_section(paper_id, section=None, instructions=None):
+    """Rewrite one section of a stored paper and store the result as a new version.
+
+    The outline stored with the paper is the context; papers stored without one (e.g.
+    migrated from the JSON cache) fall back to the outline checkpoint, if it still exists,
+    and then to an outline rebuilt from the paper's own section headings. Costs a single model call.
+    Returns the new version's id, or None if paper_id is unknown. Raises ValueError when
+    the section cannot be identified.
+    """
+    entry = paper_store.get_by_id(paper_id)
+    if entry is None:
+        return None
+    latex = entry['paper']
+    spans = section_spans(latex)
+    titles = [SECTION_TITLE_PATTERN.match(latex, start).group(1).strip() for start, _ in spans]
+    if not titles:
+        raise ValueError("The paper has no \\section headings to regenerate")
+    index = find_section(titles, section, instructions)
+    context = paper_context(latex)
+    outline = entry['outline']
+    if not outline:
+        checkpoint = stage_cache.get(stage_key("outline", [normalize_topic(entry['topic'])], entry['params']))
+        outline = checkpoint['output'] if checkpoint else {'title': context['title'], 'sections': titles}
+    plans = {normalize_topic(s['title']): s['plan'] for s in outline_sections(outline)}
+    sections = [{'title': title, 'plan': plans.get(normalize_topic(title), '')} for title in titles]
+    start, end = spans[index]
+    current = latex[start:end]
+    text = generate_section(outline, sections, index, context, current=current.strip(), instructions=instructions)
+    if not text:
+        raise Exception(f"Failed to regenerate section '{titles[index]}'")
+    # Keep the blank lines that separated the old section from whatever follows it
+    trailing = current[len(current.rstrip()):] or "\n\n"
+    new_id = paper_store.add_version(entry, splice_fragments(latex, [spans[index]], [text.strip() + trailing]))
+    logger.info("Regenerated section %r of paper %d as paper %d", titles[index], paper_id, new_id)
+    return new_id
 
 @app.route('/', methods=['GET'])
 def index():
     return render_template('index.html')
 
+# Background job queue: /generate enqueues a job and a bounded pool of worker
+# threads runs the pipeline, so HTTP requests never wait on the LLM calls.
+jobs = {}
+jobs_lock = threading.Lock()
+job_queue = queue.Queue(maxsize=JOB_QUEUE_SIZE)
+_job_workers = []
+
+def _new_job(topic, status):
+    now = time.time()
+    return {'id': uuid.uuid4().hex, 'topic': topic, 'status': status, 'stage': None,
+            'paper': None, 'paper_id': None, 'cached': False, 'matched_topic': None, 'similarity': None,
+            'coalesced': False, 'error': None,
+            'created_at': now, 'started_at': None, 'finished_at': None,
+            'events': [], 'changed': threading.Condition(jobs_lock)}
+
+def _prune_jobs():
+    """Drop finished jobs older than JOB_RETENTION seconds. Caller holds jobs_lock."""
+    cutoff = time.time() - JOB_RETENTION
+    expired = [job_id for job_id, job in jobs.items()
+               if job['finished_at'] is not None and job['finished_at'] < cutoff]
+    for job_id in expired:
+        del jobs[job_id]
+
+def _register_job(job):
+    with jobs_lock:
+        _prune_jobs()
+        jobs[job['id']] = job
+
+def _emit(job, event, data):
+    """Append an event to the job's stream and wake its listeners. Caller holds jobs_lock."""
+    job['events'].append((event, data))
+    job['changed'].notify_all()
+
+def _job_stage(job_id, stage):
+    with jobs_lock:
+        job = jobs.get(job_id)
+        if job is not None:
+            job['stage'] = stage
+            _emit(job, 'stage', {'stage': stage, 'stage_index': STAGES.index(stage)})
+
+def _job_token(job_id, text, part=None):
+    with jobs_lock:
+        job = jobs.get(job_id)
+        if job is not None:
+            data = {'stage': job['stage']}
+            if part is not None:
+                data['part'] = part
+            if text is None:
+                _emit(job, 'reset', data)
+            else:
+                _emit(job, 'token', dict(data, text=text))
+
+def _job_coalesced(job_id):
+    with jobs_lock:
+        job = jobs.get(job_id)
+        if job is not None:
+            job['coalesced'] = True
+            _emit(job, 'coalesced', {})
+
+def _finish_job(job, status, **fields):
+    """Mark a job finished and emit its terminal event. Caller holds jobs_lock."""
+    job.update(status=status, stage=None, finished_at=time.time(), **fields)
+    if status == 'completed':
+        _emit(job, 'completed', {'paper': job['paper'], 'paper_id': job['paper_id'], 'cached': job['cached'],
+                                 'matched_topic': job['matched_topic'], 'similarity': job['similarity']})
+    else:
+        _emit(job, 'failed', {'error': job['error']})
+
+def _ensure_job_workers():
+    """Start the worker pool on first use rather than at import time"""
+    with jobs_lock:
+        if _job_workers:
+            return
+        for i in range(JOB_WORKERS):
+            worker = threading.Thread(target=_job_worker, name=f"job-worker-{i}", daemon=True)
+            worker.start()
+            _job_workers.append(worker)
+
+def _job_worker():
+    while True:
+        job_id = job_queue.get()
+        try:
+            run_job(job_id)
+        finally:
+            job_queue.task_done()
+
+def run_job(job_id):
+    """Run the generation pipeline for a queued job and record the outcome"""
+    with jobs_lock:
+        job = jobs.get(job_id)
+        if job is None:
+            return
+        topic = job['topic']
+        job.update(status='running', started_at=time.time())
+    try:
+        result, cached = generate_paper_cached(topic,
+                                               on_stage=lambda stage: _job_stage(job_id, stage),
+                                               on_token=lambda text, part=None: _job_token(job_id, text, part),
+                                               on_follow=lambda: _job_coalesced(job_id))
+        with jobs_lock:
+            _finish_job(job, 'completed', cached=cached, **result)
+    except Exception as e:
+        logger.exception("Job %s failed", job_id)
+        with jobs_lock:
+            _finish_job(job, 'failed', error=f'Error: {str(e)}')
+
+def submit_job(topic):
+    """Queue a generation job for topic. Returns the job, or None if the queue is full."""
+    job = _new_job(topic, 'queued')
+    _register_job(job)
+    try:
+        job_queue.put_nowait(job['id'])
+    except queue.Full:
+        with jobs_lock:
+            jobs.pop(job['id'], None)
+        return None
+    _ensure_job_workers()
+    return job
+
+def job_view(job):
+    """JSON-serializable snapshot of a job for the API"""
+    def iso(ts):
+        return datetime.fromtimestamp(ts).isoformat() if ts is not None else None
+    view = {
+        'job_id': job['id'],
+        'topic': job['topic'],
+        'status': job['status'],
+        'stage': job['stage'],
+        'stage_index': STAGES.index(job['stage']) if job['stage'] in STAGES else None,
+        'stage_count': len(STAGES),
+        'cached': job['cached'],
+        'coalesced': job['coalesced'],
+        'created_at': iso(job['created_at']),
+        'started_at': iso(job['started_at']),
+        'finished_at': iso(job['finished_at']),
+        'status_url': url_for('get_job', job_id=job['id']),
+        'events_url': url_for('job_events', job_id=job['id']),
+    }
+    if job['status'] == 'completed':
+        if job['matched_topic']:
+            # Served the paper of a near-duplicate topic rather than one generated for this topic
+            view['matched_topic'] = job['matched_topic']
+            view['similarity'] = job['similarity']
+        view['paper'] = job['paper']
+        view['paper_id'] = job['paper_id']
+        if job['paper_id'] is not None:
+            view['paper_url'] = url_for('get_paper', paper_id=job['paper_id'])
+    if job['status'] == 'failed':
+        view['error'] = job['error']
+    return view
+
 @app.route('/generate', methods=['POST'])
 def generate_paper():
     data = request.json
     topic = data.get('topic', '').strip()
     if not topic:
         return jsonify({'error': 'Please provide a research topic or title'}), 400
-    cached_paper = get_cached_paper(topic)
-    if cached_paper:
-        return jsonify({'paper': cached_paper, 'cached': True})
+    cached = get_cached_result(topic)
+    if cached:
+        job = _new_job(topic, 'queued')
+        job.update(cached=True, **cached)
+        with jobs_lock:
+            _finish_job(job, 'completed')
+        _register_job(job)
+        return jsonify(job_view(job))
+    job = submit_job(topic)
+    if job is None:
+        return jsonify({'error': 'The server is busy. Please try again shortly.'}), 503, {'Retry-After': '30'}
+    with jobs_lock:
+        view = job_view(job)
+    return jsonify(view), 202
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    with jobs_lock:
+        job = jobs.get(job_id)
+        if job is None:
+            return jsonify({'error': 'Unknown job'}), 404
+        view = job_view(job)
+    return jsonify(view)
+
+@app.route('/jobs/<job_id>/events', methods=['GET'])
+def job_events(job_id):
+    """Stream a job's stage transitions, model tokens and outcome as Server-Sent Events
+
+    Every event carries its index as the SSE id, so a reconnecting EventSource resumes
+    from Last-Event-ID and late subscribers replay the job from the start.
+    """
+    with jobs_lock:
+        job = jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
     try:
-        final_paper = generate_research_paper(topic)
-        save_to_cache(topic, final_paper)
-        return jsonify({'paper': final_paper, 'cached': False})
+        start = int(request.headers.get('Last-Event-ID', -1)) + 1
+    except ValueError:
+        start = 0
+
+    def stream():
+        index = start
+        while True:
+            with jobs_lock:
+                if index >= len(job['events']) and job['finished_at'] is None:
+                    job['changed'].wait(timeout=15)
+                pending = job['events'][index:]
+                finished = job['finished_at'] is not None
+            if not pending and not finished:
+                yield ': keep-alive\n\n'
+            for event, data in pending:
+                yield f"id: {index}\nevent: {event}\ndata: {json.dumps(data)}\n\n"
+                index += 1
+            if finished and index >= len(job['events']):
+                return
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# Batches started through /generate/batch, by batch id
+batches = {}
+batches_lock = threading.Lock()
+
+def batch_output_path(batch_id):
+    return os.path.join(BATCH_DIR, f"{batch_id}.jsonl")
+
+def _run_batch_job(batch_id, records):
+    def on_result(result):
+        with batches_lock:
+            batches[batch_id][result['status']] += 1
+    try:
+        run_batch(records, batch_output_path(batch_id), on_result=on_result)
+        status, error = 'completed', None
     except Exception as e:
-        import traceback
-        traceback.print_exc()
-        return jsonify({'error': f'Error: {str(e)}'}), 500
-
-def create_template_files():
-    os.makedirs('templates', exist_ok=True)
-    with open('templates/index.html', 'w', encoding='utf-8') as f:
-        f.write("""
-<!DOCTYPE html>
-<html lang="en">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>Advanced AI Research Paper Generator</title>
-    <style>
-        body { font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif; max-width: 900px; margin: 0 auto; padding: 20px; line-height: 1.6; color: #333; background-color: #f8f9fa; }
-        h1 { text-align: center; margin-bottom: 30px; color: #2c3e50; border-bottom: 2px solid #3498db; padding-bottom: 10px; }
-        .container { background-color: white; border-radius: 8px; box-shadow: 0 4px 6px rgba(0, 0, 0, 0.1); padding: 30px; }
-        label { display: block; margin-bottom: 8px; font-weight: 600; color: #2c3e50; }
-        .input-group { display: flex; margin-bottom: 20px; }
-        input { flex-grow: 1; padding: 12px; border: 1px solid #ddd; border-radius: 4px 0 0 4px; font-size: 16px; transition: border-color 0.3s; }
-        input:focus { outline: none; border-color: #3498db; box-shadow: 0 0 0 2px rgba(52, 152, 219, 0.2); }
-        button { padding: 12px 24px; background-color: #3498db; color: white; border: none; border-radius: 0 4px 4px 0; cursor: pointer; font-size: 16px; transition: background-color 0.3s; }
-        button:hover { background-color: #2980b9; }
-        button:disabled { background-color: #95a5a6; cursor: not-allowed; }
-        .loading { text-align: center; padding: 40px 0; display: none; }
-        .loading-spinner { border: 5px solid #f3f3f3; border-top: 5px solid #3498db; border-radius: 50%; width: 50px; height: 50px; animation: spin 2s linear infinite; margin: 0 auto 20px; }
-        @keyframes spin { 0% { transform: rotate(0deg); } 100% { transform: rotate(360deg); } }
-        .stages { max-width: 600px; margin: 20px auto; padding: 0; list-style: none; }
-        .stage { padding: 10px; margin-bottom: 8px; border-radius: 4px; background-color: #f1f1f1; color: #7f8c8d; position: relative; padding-left: 40px; transition: all 0.3s; }
-        .stage::before { content: "○"; position: absolute; left: 15px; font-size: 18px; }
-        .stage.active { background-color: #e1f0fa; color: #3498db; font-weight: 500; }
-        .stage.active::before { content: "●"; color: #3498db; }
-        .stage.completed { background-color: #e8f8f5; color: #27ae60; }
-        .stage.completed::before { content: "✓"; color: #27ae60; }
-        .output { margin-top: 30px; display: none; }
-        .output-header { display: flex; justify-content: space-between; align-items: center; margin-bottom: 15px; }
-        .copy-btn { padding: 8px 16px; font-size: 14px; background-color: #2ecc71; color: white; border: none; border-radius: 4px; cursor: pointer; transition: background-color 0.3s; }
-        .copy-btn:hover { background-color: #27ae60; }
-        pre { background-color: #f9f9f9; border: 1px solid #ddd; border-radius: 4px; padding: 15px; white-space: pre-wrap; overflow-x: auto; font-family: 'Courier New', monospace; font-size: 14px; max-height: 500px; overflow-y: auto; }
-        .next-steps { background-color: #e8f0fe; border: 1px solid #d0e1f9; border-radius: 4px; padding: 20px; margin-top: 30px; }
-        .next-steps h3 { color: #2c3e50; margin top: 0; border-bottom: 1px solid #d0e1f9; padding-bottom: 10px; }
-        .next-steps ol { padding-left: 20px; }
-        .next-steps li { margin-bottom: 8px; }
-        .error { color: #e74c3c; background-color: #fadbd8; padding: 10px 15px; border-radius: 4px; margin-top: 10px; display: none; border-left: 4px solid #e74c3c; }
-        footer { text-align: center; margin-top: 40px; color: #7f8c8d; font-size: 14px; }
-    </style>
-</head>
-<body>
-    <div class="container">
-        <h1>Advanced AI Research Paper Generator</h1>
-        <div>
-            <label for="topic">Enter Research Topic or Title:</label>
-            <div class="input-group">
-                <input type="text" id="topic" placeholder="e.g., The Impact of Artificial Intelligence on Climate Change Mitigation">
-                <button id="generate-btn">Generate Paper</button>
-            </div>
-            <div class="error" id="error-message"></div>
-        </div>
-        <div class="loading" id="loading">
-            <div class="loading-spinner"></div>
-            <p>Generating your high-quality research paper...</p>
-            <p style="font-size: 14px; color: #666;">This process takes 3-5 minutes as our AI crafts a comprehensive academic paper.</p>
-            <ul class="stages">
-                <li class="stage" id="stage-1">Planning research structure and approach</li>
-                <li class="stage" id="stage-2">Creating LaTeX template with appropriate packages</li>
-                <li class="stage" id="stage-3">Generating detailed academic content</li>
-                <li class="stage" id="stage-4">Enhancing citations and references</li>
-                <li class="stage" id="stage-5">Improving diagrams and visualizations</li>
-                <li class="stage" id="stage-6">Final polishing and quality assurance</li>
-            </ul>
-        </div>
-        <div class="output" id="output">
-            <div class="output-header">
-                <h2>Generated LaTeX Research Paper</h2>
-                <button class="copy-btn" id="copy-btn">Copy to Clipboard</button>
-            </div>
-            <pre id="latex-output"></pre>
-            <div class="next-steps">
-                <h3>Next Steps:</h3>
-                <ol>
-                    <li>Copy the LaTeX code to your preferred LaTeX editor (Overleaf, TeXstudio, etc.)</li>
-                    <li>Check for any compilation errors and make minor adjustments if needed</li>
-                    <li>Compile the document to generate your PDF research paper</li>
-                    <li>Review and modify the content as necessary for your specific needs</li>
-                    <li>If using Overleaf, create a new project and paste this code to immediately see the compiled PDF</li>
-                </ol>
-            </div>
-        </div>
-    </div>
-    <footer>
-        <p>Powered by OpenRouter AI &copy; 2025</p>
-    </footer>
-    <script>
-        document.addEventListener('DOMContentLoaded', function() {
-            const topicInput = document.getElementById('topic');
-            const generateBtn = document.getElementById('generate-btn');
-            const loading = document.getElementById('loading');
-            const output = document.getElementById('output');
-            const latexOutput = document.getElementById('latex-output');
-            const copyBtn = document.getElementById('copy-btn');
-            const errorMessage = document.getElementById('error-message');
-            const stages = document.querySelectorAll('.stage');
-            function simulateProgress() {
-                const stageDurations = [8000, 15000, 60000, 25000, 30000, 20000];
-                let currentStage = 0;
-                function updateStage() {
-                    if (currentStage < stages.length) {
-                        stages.forEach((stage, index) => {
-                            stage.classList.remove('active');
-                            if (index < currentStage) {
-                                stage.classList.add('completed');
-                            }
-                        });
-                        stages[currentStage].classList.add('active');
-                        currentStage++;
-                        if (currentStage < stages.length) {
-                            setTimeout(updateStage, stageDurations[currentStage - 1]);
-                        }
-                    }
-                }
-                updateStage();
-            }
-            generateBtn.addEventListener('click', async function() {
-                const topic = topicInput.value.trim();
-                if (!topic) {
-                    errorMessage.textContent = 'Please enter a research topic or title';
-                    errorMessage.style.display = 'block';
-                    return;
-                }
-                errorMessage.style.display = 'none';
-                loading.style.display = 'block';
-                output.style.display = 'none';
-                generateBtn.disabled = true;
-                stages.forEach(stage => {
-                    stage.classList.remove('active', 'completed');
-                });
-                simulateProgress();
-                try {
-                    const response = await fetch('/generate', {
-                        method: 'POST',
-                        headers: {
-                            'Content-Type': 'application/json'
-                        },
-                        body: JSON.stringify({ topic })
-                    });
-                    const data = await response.json();
-                    if (data.error) {
-                        errorMessage.textContent = data.error;
-                        errorMessage.style.display = 'block';
-                    } else {
-                        stages.forEach(stage => {
-                            stage.classList.remove('active');
-                            stage.classList.add('completed');
-                        });
-                        latexOutput.textContent = data.paper;
-                        output.style.display = 'block';
-                    }
-                } catch (error) {
-                    errorMessage.textContent = 'An error occurred. Please try again.';
-                    errorMessage.style.display = 'block';
-                } finally {
-                    loading.style.display = 'none';
-                    generateBtn.disabled = false;
-                }
-            });
-            copyBtn.addEventListener('click', function() {
-                navigator.clipboard.writeText(latexOutput.textContent)
-                    .then(() => {
-                        const originalText = copyBtn.textContent;
-                        copyBtn.textContent = 'Copied!';
-                        setTimeout(() => {
-                            copyBtn.textContent = originalText;
-                        }, 2000);
-                    })
-                    .catch(err => {
-                        console.error('Failed to copy: ', err);
-                    });
-            });
-        });
-    </script>
-</body>
-</html>
-        """)
+        logger.exception("Batch %s failed", batch_id)
+        status, error = 'failed', f'Error: {str(e)}'
+    with batches_lock:
+        batches[batch_id].update(status=status, error=error, finished_at=datetime.now().isoformat())
+
+def batch_view(batch_id, batch):
+    view = dict(batch, batch_id=batch_id,
+                status_url=url_for('get_batch', batch_id=batch_id),
+                results_url=url_for('get_batch_results', batch_id=batch_id))
+    if view.get('error') is None:
+        view.pop('error', None)
+    return view
+
+@app.route('/generate/batch', methods=['POST'])
+def generate_batch():
+    """Start a batch from a JSONL body or an uploaded 'file'.
+
+    The batch id is derived from the content, so posting the same list again resumes it.
+    """
+    upload = request.files.get('file')
+    content = upload.read().decode('utf-8') if upload else request.get_data(as_text=True)
+    records = read_batch_topics(content.splitlines())
+    if not records:
+        return jsonify({'error': 'Please provide JSONL lines with a topic or title'}), 400
+    batch_id = hashlib.sha256("\n".join(f"{r['id']}\t{r['topic']}" for r in records).encode('utf-8')).hexdigest()[:16]
+    with batches_lock:
+        batch = batches.get(batch_id)
+        if batch is not None and batch['status'] == 'running':
+            return jsonify(batch_view(batch_id, batch)), 202
+        done = sum(1 for result in read_batch_results(batch_output_path(batch_id)).values()
+                   if result.get('status') == 'completed')
+        batch = {'status': 'running', 'total': len(records), 'skipped': done, 'completed': 0, 'failed': 0,
+                 'error': None, 'started_at': datetime.now().isoformat(), 'finished_at': None}
+        batches[batch_id] = batch
+        view = batch_view(batch_id, batch)
+    threading.Thread(target=_run_batch_job, args=(batch_id, records), name=f"batch-{batch_id}", daemon=True).start()
+    return jsonify(view), 202
+
+@app.route('/generate/batch/<batch_id>', methods=['GET'])
+def get_batch(batch_id):
+    with batches_lock:
+        batch = batches.get(batch_id)
+        if batch is not None:
+            return jsonify(batch_view(batch_id, batch))
+    results = read_batch_results(batch_output_path(batch_id))
+    if not results:
+        return jsonify({'error': 'Unknown batch'}), 404
+    # Started by an earlier process: report what its output file holds
+    counts = {'completed': 0, 'failed': 0}
+    for result in results.values():
+        counts[result.get('status')] = counts.get(result.get('status'), 0) + 1
+    return jsonify(batch_view(batch_id, {'status': 'stopped', 'completed': counts['completed'], 'failed': counts['failed']}))
+
+@app.route('/generate/batch/<batch_id>/results', methods=['GET'])
+def get_batch_results(batch_id):
+    output_path = batch_output_path(batch_id)
+    if not re.fullmatch(r'[0-9a-f]{16}', batch_id) or not os.path.exists(output_path):
+        return jsonify({'error': 'Unknown batch'}), 404
+    return send_file(os.path.abspath(output_path), mimetype='application/x-ndjson')
+
+PAPERS_MAX_PER_PAGE = 100
+
+@app.route('/papers', methods=['GET'])
+def list_papers():
+    """Paginated paper history. Query parameters: q (topic search), model, sort (created|size), page, per_page."""
+    if paper_store is None:
+        return jsonify({'error': 'Paper storage is disabled'}), 404
+    try:
+        page = max(1, int(request.args.get('page', 1)))
+        per_page = min(PAPERS_MAX_PER_PAGE, max(1, int(request.args.get('per_page', 20))))
+    except ValueError:
+        return jsonify({'error': 'page and per_page must be integers'}), 400
+    papers, total = paper_store.search(query=request.args.get('q', '').strip() or None,
+                                       model=request.args.get('model') or None,
+                                       page=page, per_page=per_page, sort=request.args.get('sort', 'created'))
+    for paper in papers:
+        paper['created_at'] = datetime.fromtimestamp(paper['created_at']).isoformat()
+        paper['url'] = url_for('get_paper', paper_id=paper['id'])
+    return jsonify({'papers': papers, 'page': page, 'per_page': per_page, 'total': total,
+                    'pages': (total + per_page - 1) // per_page})
+
+@app.route('/papers/<int:paper_id>', methods=['GET'])
+def get_paper(paper_id):
+    entry = paper_store.get_by_id(paper_id) if paper_store is not None else None
+    if entry is None:
+        return jsonify({'error': 'Unknown paper'}), 404
+    return jsonify({'id': entry['id'], 'topic': entry['topic'], 'model': entry['model'], 'params': entry['params'],
+                    'created_at': entry['timestamp'], 'size': entry['size'], 'stored_size': entry['stored_size'],
+                    'parent_id': entry['parent_id'], 'version': entry['version'], 'paper': entry['paper']})
+
+@app.route('/papers/<int:paper_id>', methods=['DELETE'])
+def delete_paper(paper_id):
+    """Delete a stored paper or edited version. Versions made from it keep their parent_id."""
+    if paper_store is None or not paper_store.delete(paper_id):
+        return jsonify({'error': 'Unknown paper'}), 404
+    return '', 204
+
+@app.route('/papers/<int:paper_id>/sections', methods=['POST'])
+def regenerate_paper_section(paper_id):
+    """Rewrite one section of a stored paper. Body: {"section": title or 1-based number, "instructions": "..."};
+    at least one is required. The result is stored as a new version and returned."""
+    if paper_store is None:
+        return jsonify({'error': 'Paper storage is disabled'}), 404
+    data = request.get_json(silent=True)
+    if data is None:
+        data = {}
+    if not isinstance(data, dict):
+        return jsonify({'error': 'The request body must be a JSON object'}), 400
+    section = data.get('section')
+    if isinstance(section, bool) or not isinstance(section, (str, int, type(None))):
+        return jsonify({'error': 'section must be a section title or number'}), 400
+    if section == '':
+        section = None
+    instructions = data.get('instructions')
+    if not isinstance(instructions, (str, type(None))):
+        return jsonify({'error': 'instructions must be a string'}), 400
+    instructions = (instructions or '').strip() or None
+    if section is None and not instructions:
+        return jsonify({'error': 'Please provide a section or instructions'}), 400
+    try:
+        new_id = regenerate_section(paper_id, section, instructions)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error("Error regenerating section of paper %d: %s", paper_id, e)
+        return jsonify({'error': str(e)}), 502
+    if new_id is None:
+        return jsonify({'error': 'Unknown paper'}), 404
+    response = get_paper(new_id)
+    response.status_code = 201
+    response.headers['Location'] = url_for('get_paper', paper_id=new_id)
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus text exposition of pipeline, OpenRouter, cache and job metrics"""
+    with jobs_lock:
+        counts = {status: 0 for status in ('queued', 'running', 'completed', 'failed')}
+        for job in jobs.values():
+            counts[job['status']] += 1
+    for status, count in counts.items():
+        metrics.set("jobs", count, status=status)
+    metrics.set("job_queue_depth", job_queue.qsize())
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+def serve_production(host, port, connections, job_workers):
+    """Serve the app with gunicorn's gevent worker, replacing this process with gunicorn.
+
+    gevent makes the pipeline's blocking calls (HTTP, sleeps, locks, queues) cooperative,
+    so each in-flight generation is a greenlet waiting on a socket rather than an OS
+    thread, and one process can carry hundreds of them. gunicorn is exec'd on main:app
+    in a fresh interpreter, so the worker patches the standard library before anything
+    (requests, ssl) is imported. There is exactly one worker process: jobs and their
+    event streams live in the memory of the process that accepted them.
+    """
+    try:
+        import gunicorn  # noqa: F401
+        import gevent  # noqa: F401 -- required by the gevent worker class
+    except ImportError:
+        raise SystemExit("The production server needs gunicorn and gevent: pip install gunicorn gevent")
+
+    env = dict(os.environ, JOB_WORKERS=str(job_workers))
+    command = [sys.executable, "-m", "gunicorn",
+               "--chdir", os.path.dirname(os.path.abspath(__file__)),
+               "--bind", f"{host}:{port}",
+               "--workers", "1",
+               "--worker-class", "gevent",
+               "--worker-connections", str(connections),
+               "--access-logfile", "-",
+               "--log-level", LOG_LEVEL.lower(),
+               "main:app"]
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.execvpe(sys.executable, command, env)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Research paper generator")
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('dev', help="run the Flask development server with the reloader (the default)")
+    serve_parser = commands.add_parser('serve', help="run the production server (gunicorn with a gevent worker)")
+    serve_parser.add_argument('--host', default=SERVE_HOST)
+    serve_parser.add_argument('--port', type=int, default=SERVE_PORT)
+    serve_parser.add_argument('--connections', type=int, default=SERVE_CONNECTIONS,
+                              help="concurrent connections")
+    serve_parser.add_argument('--job-workers', type=int, default=SERVE_JOB_WORKERS,
+                              help="concurrent pipeline runs (sets JOB_WORKERS)")
+    batch_parser = commands.add_parser('batch', help="generate papers for every topic in a JSONL file")
+    batch_parser.add_argument('input', help="JSONL file with a 'topic' or 'title' on each line")
+    batch_parser.add_argument('-o', '--output', help="JSONL file results are appended to (default: <input>.results.jsonl)")
+    batch_parser.add_argument('-c', '--concurrency', type=int, default=BATCH_CONCURRENCY,
+                              help="topics generated at once")
+    args = parser.parse_args(argv)
+    configure_logging()
+
+    if args.command == 'batch':
+        with open(args.input, 'r', encoding='utf-8') as f:
+            records = read_batch_topics(f)
+        output_path = args.output or f"{os.path.splitext(args.input)[0]}.results.jsonl"
+        def report(result):
+            print(f"[{result['status']}] {result['id']}: {result['topic']} ({result['seconds']}s)")
+        summary = run_batch(records, output_path, concurrency=args.concurrency, on_result=report)
+        print(f"Batch finished: {summary['completed']} completed, {summary['failed']} failed, "
+              f"{summary['skipped']} already done, {summary['total']} total. Results in {output_path}")
+        return 1 if summary['failed'] else 0
+
+    if args.command == 'serve':
+        serve_production(args.host, args.port, args.connections, args.job_workers)
+        return 0
 
-if __name__ == '__main__':
-    create_template_files()
     app.run(debug=True)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,133 @@
+"""Model routing tests against a local mock of the OpenRouter streaming API.
+
+Run with: python -m unittest test_routing
+"""
+import os
+import sys
+import json
+import time
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+main = None
+
+
+def setUpModule():
+    global main
+    # main.py keeps its cache under the working directory; keep the test's out of the repo
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(tempfile.mkdtemp())
+    import main as module
+    main = module
+
+
+class ScriptedOpenRouter:
+    """Streams each model's scripted events: ("token", text), ("sleep", seconds) or ("error", message)"""
+
+    def __init__(self, scripts):
+        self.scripts = scripts
+        self.server = None
+
+    def handler(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                try:
+                    self.chunk(": OPENROUTER PROCESSING\n\n")
+                    for kind, value in mock.scripts[payload["model"]]:
+                        if kind == "sleep":
+                            time.sleep(value)
+                        elif kind == "token":
+                            self.chunk(f"data: {json.dumps({'choices': [{'delta': {'content': value}}]})}\n\n")
+                        elif kind == "error":
+                            self.chunk(f"data: {json.dumps({'error': {'code': 400, 'message': value}})}\n\n")
+                    self.chunk("data: [DONE]\n\n")
+                    self.wfile.write(b"0\r\n\r\n")
+                    self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def chunk(self, text):
+                data = text.encode("utf-8")
+                self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+                self.wfile.flush()
+
+        return Handler
+
+    def start(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.handler())
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return f"http://127.0.0.1:{self.server.server_port}/api/v1/chat/completions"
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def preview(tokens):
+    """The text a streaming client shows after these on_token calls; None clears it"""
+    text = ""
+    for token in tokens:
+        text = "" if token is None else text + token
+    return text
+
+
+class ModelRouterTest(unittest.TestCase):
+    def route(self, scripts, hedge_after):
+        """Run one routed call with hedging after hedge_after seconds; returns (text, on_token calls, seconds)"""
+        mock = ScriptedOpenRouter(scripts)
+        url = mock.start()
+        self.addCleanup(mock.stop)
+        original = main.openrouter_client
+        main.openrouter_client = main.OpenRouterClient(url, "test-key", max_retries=1,
+                                                       max_concurrency=1, timeout=10)
+        self.addCleanup(setattr, main, "openrouter_client", original)
+        models = list(scripts)
+        router = main.ModelRouter(min_samples=1, hedging=True)
+        router.models = lambda stage: models
+        router.record_latency("test", models[0], hedge_after)
+        tokens = []
+        started = time.monotonic()
+        text = router.chat({"messages": [{"role": "user", "content": "hi"}]}, tokens.append, stage="test")
+        return text, tokens, time.monotonic() - started, mock
+
+    def test_hedge_wins_when_first_streamer_fails(self):
+        text, tokens, seconds, mock = self.route({
+            "model-a": [("sleep", 0.3), ("token", "partial "), ("sleep", 0.3), ("error", "upstream failed")],
+            "model-b": [("sleep", 0.5), ("token", "hedged "), ("token", "answer")],
+        }, hedge_after=0.1)
+        self.assertEqual(text, "hedged answer")
+        self.assertLess(seconds, 5)
+        # The preview followed model-a until it failed, then switched to model-b
+        self.assertEqual(tokens[0], "partial ")
+        self.assertEqual(preview(tokens), "hedged answer")
+
+    def test_loser_is_cancelled_mid_stream(self):
+        text, tokens, seconds, mock = self.route({
+            "model-a": [("sleep", 0.2), ("token", "slow "), ("sleep", 3), ("token", "answer")],
+            "model-b": [("token", "fast "), ("token", "answer")],
+        }, hedge_after=0.05)
+        self.assertEqual(text, "fast answer")
+        self.assertLess(seconds, 2)
+        self.assertEqual(preview(tokens), "fast answer")
+        # model-a's server still has seconds to go; its call must end once model-b wins
+        loser = [t for t in threading.enumerate() if t.name == "openrouter-test-0"]
+        for thread in loser:
+            thread.join(1)
+        self.assertFalse(any(thread.is_alive() for thread in loser))
+
+
+if __name__ == "__main__":
+    unittest.main()
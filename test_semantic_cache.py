@@ -0,0 +1,73 @@
+"""Near-duplicate topic matching in the paper cache.
+
+Run with: python -m unittest test_semantic_cache
+"""
+import os
+import sys
+import tempfile
+import unittest
+
+main = None
+
+
+def setUpModule():
+    global main
+    # main.py keeps its cache under the working directory; keep the test's out of the repo
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(tempfile.mkdtemp())
+    import main as module
+    main = module
+
+
+class SemanticCacheTest(unittest.TestCase):
+    TOPICS = ["Impact of AI on climate change", "Quantum error correction", "Renewable energy storage"]
+
+    def setUp(self):
+        if main.np is None:
+            self.skipTest("NumPy is not installed")
+        directory = tempfile.mkdtemp()
+        self.saved = {name: getattr(main, name) for name in ('memory_cache', 'paper_store', 'topic_index')}
+        main.memory_cache = main.LRUCache(16)
+        main.paper_store = main.PaperStore(os.path.join(directory, "papers.db"), on_evict=main.forget_cache_entry)
+        main.topic_index = None
+        for topic in self.TOPICS:
+            main.save_to_cache(topic, f"paper about {topic}")
+
+    def tearDown(self):
+        for name, value in self.saved.items():
+            setattr(main, name, value)
+
+    def test_paraphrases_match(self):
+        for topic in ("AI's impact on climate change", "The impacts of AI on climate change",
+                      "AI impact on climate change"):
+            result = main.get_cached_result(topic)
+            self.assertIsNotNone(result, topic)
+            self.assertEqual(result['matched_topic'], "Impact of AI on climate change")
+            self.assertGreaterEqual(result['similarity'], main.SEMANTIC_PAPER_THRESHOLD)
+
+    def test_reversed_topics_do_not_match(self):
+        for topic in ("Climate change impact on AI", "Impact of climate change on AI",
+                      "Climate change's impact on AI"):
+            self.assertIsNone(main.get_cached_result(topic), topic)
+            self.assertIsNone(main.similar_topic(topic, main.SEMANTIC_OUTLINE_THRESHOLD, "outline"), topic)
+
+    def test_evicted_topic_is_not_matched(self):
+        main.paper_store.max_bytes = 0
+        main.paper_store.put("other", "Unrelated topic", "x", main.generation_params(), "fingerprint")
+        self.assertIsNone(main.get_cached_result("AI's impact on climate change"))
+        self.assertEqual(main.topic_index.search("AI's impact on climate change", main.params_fingerprint()),
+                         (None, 0.0))
+
+    def test_stale_best_match_falls_through_to_the_next(self):
+        main.save_to_cache("AI impacts on climate change", "second paper")
+        # Removed behind the cache's back, so no eviction callback runs
+        stale = main.cache_key("Impact of AI on climate change")
+        main.paper_store.db.execute("DELETE FROM papers WHERE cache_key = ?", (stale,))
+        main.memory_cache.discard(stale)
+        result = main.get_cached_result("AI's impact on climate change")
+        self.assertEqual(result['matched_topic'], "AI impacts on climate change")
+        self.assertEqual(result['paper'], "second paper")
+
+
+if __name__ == "__main__":
+    unittest.main()